@@ -1,33 +1,109 @@
 """Implements Pipeline class."""
 import abc
+import heapq
+import itertools
 import multiprocessing
-from typing import Any, Generic, Iterable, TypeVar
+import threading
+from multiprocessing.pool import Pool, ThreadPool
+from typing import Any, Generic, Iterable, Sequence, TypeVar
 
 from .work_exception import WorkException
+from .Worker import TAG_BATCH, TAG_DATA, init_pool
 
-from . import Stage
+from .SimpleStage import SimpleStage
+from .Stage import Stage
 
 
 T = TypeVar('T')
 Q = TypeVar('Q')
 
+# How long run() waits for its feeder thread to put an input, once done reading, in seconds.
+_FEED_WAIT = 1.0
+
 
 class Pipeline(Generic[T,Q]):
     """A pipeline of stages."""
-    def __init__(self, input_stage: Stage[T,Any]):
-        """Constructor takes the root upstream stage."""
+    def __init__(self, input_stage: Stage[T,Any], fuse:bool=False, start_method:str|None=None):
+        """Constructor takes the root upstream stage.
+        With *fuse*, runs of linked :class:`SimpleStage` objects alike
+        are merged into single stages (see :meth:`SimpleStage.fuse`),
+        saving the tube hops between them at the cost of pipelining.
+
+        *start_method* is the :mod:`multiprocessing` start method of the worker
+        processes, e.g. ``'forkserver'``. It defaults to the one set on
+        the stages, if any, else to the platform's default."""
         self._input_stage = input_stage
+        if fuse:
+            self._fuse()
         self._output_stages = input_stage.get_leaves()
-        self._input_stage.build()
-        self.task_index=0
-        self.lock=multiprocessing.Lock()
+        # All workers of the pipeline run on one long-lived pool per kind,
+        # instead of each stage starting up a pool of its own.
+        num_workers = {True:0, False:0}
+        next_cpu = 0
+        stages = input_stage.get_stages()
+        for stage in stages:
+            num_workers[stage.multi_process] += stage._num_worker
+            next_cpu = stage.assign_cpus(next_cpu)
+        if start_method is None:
+            start_methods = {stage._start_method for stage in stages
+                             if stage.multi_process and stage._start_method}
+            if len(start_methods) > 1:
+                raise ValueError(f'stages set different start methods: {start_methods}')
+            start_method = start_methods.pop() if start_methods else None
+        context = multiprocessing.get_context(start_method)
+        synchronized = dict[int,Any]()
+        for stage in stages:
+            synchronized.update(stage.prepare(context))
+        self._pools = dict[bool,Pool]()
+        if num_workers[True]:
+            self._pools[True] = context.Pool(num_workers[True], initializer=init_pool,
+                                             initargs=(synchronized,))
+        if num_workers[False]:
+            self._pools[False] = ThreadPool(num_workers[False], initializer=init_pool,
+                                            initargs=(synchronized,))
+        self._input_stage.build(self._pools)
+        for pool in self._pools.values():
+            pool.close()
+        # On error, a stage waits for the workers of its pool exiting on their own.
+        pool_results = {kind:[] for kind in self._pools}
+        for stage in stages:
+            pool_results[stage.multi_process] += stage._worker_results
+        for stage in stages:
+            stage._pool_results = pool_results[stage.multi_process]
+        self._counter=itertools.count()
+        # Tasks skip Stage.put(), going straight to the input tube as messages.
+        self._put_message=self._input_stage._input_tube.put
+        if len(self._output_stages) == 1:
+            # Monomorphic fast path for the common single-output pipeline.
+            self._single_out = self._output_stages[0]
+            self.get = self._get_single
         
 
+    def _fuse(self):
+        """Merge each stage with the stages following it, as far as possible."""
+        stack = [self._input_stage]
+        seen = list[Stage]()
+        while stack:
+            stage = stack.pop()
+            if stage in seen:
+                continue
+            seen.append(stage)
+            if isinstance(stage, SimpleStage):
+                while stage._next_stages and stage.fuse(stage._next_stages[0]):
+                    pass
+            stack += stage._next_stages
+
     def put(self, task:T|Exception):
         """Put *task* on the pipeline."""
-        with self.lock:
-            self._input_stage.put((self.task_index,task))
-            self.task_index+=1
+        if isinstance(task, BaseException):
+            self._input_stage.broadcast((next(self._counter),task))
+        else:
+            self._put_message((TAG_DATA,next(self._counter),task,0))
+
+    def put_batch(self, tasks:Sequence[T]):
+        """Put all *tasks* on the pipeline as a single tube message."""
+        task_indices=tuple(itertools.islice(self._counter,len(tasks)))
+        self._input_stage.put((task_indices,tuple(tasks)),TAG_BATCH)
         
 
     def get(self, timeout:float|None=None)->tuple[int,Q]|None:
@@ -39,9 +115,23 @@ class Pipeline(Generic[T,Q]):
                 
             except StopIteration:
                 pass
-            
+
+        self._join()
         return None
 
+    def _get_single(self, timeout:float|None=None)->tuple[int,Q]|None:
+        """Return result from the pipeline's only output stage."""
+        try:
+            return self._single_out.get(timeout)
+        except StopIteration:
+            self._join()
+            return None
+
+    def _join(self):
+        """Wait for all the workers to exit."""
+        for pool in self._pools.values():
+            pool.join()
+
     def results(self):
         """Return a generator to iterate over results from the pipeline."""
         while result := self.get():
@@ -53,19 +143,78 @@ class Pipeline(Generic[T,Q]):
         if len(self._output_stages) != 1:
             raise ValueError('Pipeline must have only one output stage.')
         current=0
-        cache={}
+        heap=list[tuple[int,Q]]()
         while result := self.get():
-            task_index,res=result
-            cache[task_index]=res
-            while current in cache:
-                yield cache[current]
+            if result[0] != current:
+                heapq.heappush(heap,result)
+                continue
+            # In order already: yield it without going through the heap.
+            yield result[1]
+            current+=1
+            while heap and heap[0][0] == current:
+                yield heapq.heappop(heap)[1]
                 current+=1
             
 
-    def run(self,inputs: Iterable[T],ordered_results:bool=False)->Iterable[Q]:
-        for input in inputs:
-            self.put(input)
+    def run(self,inputs: Iterable[T],ordered_results:bool=False,batch_size:int=1)->Iterable[Q]:
+        """Put all *inputs* on the pipeline and return a generator over the results.
+        The inputs are put from a thread while the results are read,
+        so that neither side waits forever on tubes the other side filled up;
+        the thread waits for room on the tubes rather than put all the inputs at once.
+        With *batch_size* > 1 the inputs are sent in micro-batches of that size,
+        amortizing the per-message tube overhead.
+
+        An error raised by *inputs* is raised by the generator, after the results
+        of the inputs before it. Closing the generator stops putting inputs,
+        and waits for the workers to finish the ones already put and exit."""
+        stop = threading.Event()
+        errors = list[Exception]()
+        feeder = threading.Thread(target=self._feed, args=(inputs,batch_size,stop,errors),
+                                  name='pipeline-feed', daemon=True)
+        feeder.start()
+        results = self.results_ordered() if ordered_results else self.results()
+        return self._run(results, feeder, stop, errors)
+
+    def _run(self, results:Iterable[Q], feeder:threading.Thread,
+             stop:threading.Event, errors:list[Exception]):
+        """Yield *results*, then raise the error of the inputs if any.
+        Stop the feeder once done."""
+        try:
+            yield from results
+            if errors:
+                raise errors[0]
+        except GeneratorExit:
+            stop.set()
+            # Read on until the workers are done with the inputs put, so that
+            # neither they nor the feeder are left waiting on tubes full of
+            # results no one reads, and exit on the feeder's "stop".
+            try:
+                while self.get() is not None:
+                    pass
+            except Exception:
+                pass
+            raise
+        finally:
+            stop.set()
+            feeder.join(_FEED_WAIT)
+
+    def _feed(self, inputs: Iterable[T], batch_size:int,
+              stop:threading.Event, errors:list[Exception]):
+        """Put all *inputs* on the pipeline, then "stop".
+        An error raised by *inputs* is kept in *errors*, for the reader of the results.
+        Skips the inputs left once *stop* is set."""
+        try:
+            if batch_size>1:
+                inputs=iter(inputs)
+                while batch:=tuple(itertools.islice(inputs,batch_size)):
+                    if stop.is_set():
+                        break
+                    self.put_batch(batch)
+            else:
+                for input in inputs:
+                    if stop.is_set():
+                        break
+                    self.put(input)
+        except Exception as e:
+            errors.append(e)
         self.put(StopIteration())
-        if ordered_results:
-            return self.results_ordered()
-        return self.results()
\ No newline at end of file
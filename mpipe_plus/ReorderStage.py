@@ -0,0 +1,56 @@
+"""Implements ReorderStage class."""
+
+from .Stage import Stage
+from .Worker import TAG_BATCH, TAG_DATA, Worker
+
+__all__ = ['ReorderStage']
+
+
+class _ReorderWorker(Worker):
+    def __init__(self):
+        super(_ReorderWorker, self).__init__()
+        # Index of the next result to put, and the results held back until then.
+        self._expected = 0
+        self._held = dict[int,object]()
+
+    def doTask(self, task):
+        return task
+
+    def putResult(self, task_index, result, tag:int=TAG_DATA):
+        """Hold *result* back until the results of all earlier tasks were put."""
+        if tag == TAG_DATA:
+            if task_index != self._expected:
+                self._held[task_index] = result
+                return
+            # In order already: put it on without holding it.
+            super(_ReorderWorker, self).putResult(task_index, result)
+            self._expected += 1
+        elif tag == TAG_BATCH:
+            self._held.update(zip(task_index,result))
+        else:
+            super(_ReorderWorker, self).putResult(task_index, result, tag)
+            return
+        held = self._held
+        while self._expected in held:
+            super(_ReorderWorker, self).putResult(self._expected, held.pop(self._expected))
+            self._expected += 1
+
+    def broadcastResult(self, task_index, result:BaseException):
+        # Tasks without a result (e.g. filtered out upstream) hold back
+        # the results after them: put these in order before stopping.
+        for index in sorted(self._held):
+            super(_ReorderWorker, self).putResult(index, self._held[index])
+        self._held.clear()
+        super(_ReorderWorker, self).broadcastResult(task_index, result)
+
+
+class ReorderStage(Stage):
+    """A stage of a single worker putting results back in the order
+    of the pipeline's tasks, e.g. after a stage of several workers.
+    Each result is held back until the results of all earlier tasks went through,
+    tracked by the task indices alone: workers need no coordination.
+
+    A task that has no result holds back the results after it until "stop"."""
+    def __init__(self, multi_process=False, name=None, show_time=False):
+        super(ReorderStage, self).__init__(_ReorderWorker, 1, multi_process,
+                                           name=name, show_time=show_time)
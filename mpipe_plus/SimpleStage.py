@@ -1,5 +1,7 @@
 """Implements UnorderedStage class."""
 
+from typing import Callable
+
 from .Stage import Stage
 from .Worker import Worker
 from .tube_q import TubeQ
@@ -11,20 +13,77 @@ class _Worker(Worker):
     def __init__(self, task_fn):
         super(_Worker, self).__init__()
         self.task_fn = task_fn
+        if getattr(task_fn, '__vectorized__', False):
+            self.doTask = self._doTaskVectorized
+            self.doTaskBatch = task_fn
 
     def doTask(self, task):
         return self.task_fn(task)
 
-    def __str__(self):
-        return self.task_fn.__name__
+    def _doTaskVectorized(self, task):
+        return self.task_fn((task,))[0]
+
+
+class _Chain:
+    """Apply *targets* one after the other, as stages in a row would:
+    a ``None`` result ends the chain."""
+    def __init__(self, targets):
+        self.targets = tuple(targets)
+        self.__name__ = '|'.join(target.__name__ for target in self.targets)
+
+    def __call__(self, task):
+        for target in self.targets:
+            task = target(task)
+            if task is None:
+                break
+        return task
 
 
 class SimpleStage(Stage):
     """A specialized :class:`~mpipe.Stage`, 
     internally creating :class:`~mpipe.UnorderedWorker` objects."""
-    def __init__(self, target, num_worker=1, disable_result=False, max_backlog=None,multi_process=True,show_time=False):
+    def __init__(self, target, num_worker=1, disable_result=False, max_backlog=None,multi_process=True,show_time=False,batch_size=1,prefetch=0,start_method=None,ring=False):
         """Constructor takes a function implementing
-        :meth:`UnorderedWorker.doTask`."""
+        :meth:`UnorderedWorker.doTask`.
+        A *target* with a true ``__vectorized__`` attribute implements
+        :meth:`Worker.doTaskBatch` instead: it takes a tuple of tasks
+        and returns their results, e.g. a micro-batch as a NumPy array.
+        The stage, and its workers, are named after *target*."""
         super(SimpleStage, self).__init__(_Worker, num_worker, multi_process,disable_result,
                                              input_tube=TubeQ(maxsize=max_backlog) if max_backlog else None,show_time=show_time,
-                                             task_fn=target)
+                                             batch_size=batch_size,prefetch=prefetch,start_method=start_method,ring=ring,
+                                             name=getattr(target, '__name__', None), task_fn=target)
+
+    @classmethod
+    def chain(cls, targets, **kwargs):
+        """Return a single stage running the functions *targets* in turn
+        on each task, saving the tube hops between separate stages.
+        Other arguments are as for the constructor."""
+        return cls(_Chain(targets), **kwargs)
+
+    def fuse(self, next_stage:Stage)->bool:
+        """Merge *next_stage*, the only stage linked to this one, into this stage
+        as by :meth:`chain`, if both run their function with the same workers
+        and *next_stage* has no other input. Return whether they were merged."""
+        if not (len(self._next_stages) == 1 and self._next_stages[0] is next_stage
+                and self._worker_class is _Worker and next_stage._worker_class is _Worker
+                and not self._disable_result and not next_stage._given_input
+                and next_stage._num_producers == self._num_worker
+                and (self._num_worker, self.multi_process, self._batch_size, self.show_time,
+                     self._prefetch, self._ring)
+                    == (next_stage._num_worker, next_stage.multi_process,
+                        next_stage._batch_size, next_stage.show_time, next_stage._prefetch,
+                        next_stage._ring)
+                and self._cpu_affinity is None and next_stage._cpu_affinity is None
+                and not any(getattr(stage._worker_args['task_fn'], '__vectorized__', False)
+                            for stage in (self, next_stage))):
+            return False
+        targets = list[Callable]()
+        for task_fn in (self._worker_args['task_fn'], next_stage._worker_args['task_fn']):
+            targets += task_fn.targets if isinstance(task_fn, _Chain) else [task_fn]
+        self._worker_args['task_fn'] = _Chain(targets)
+        self.name = self._worker_args['task_fn'].__name__
+        self._disable_result = next_stage._disable_result
+        self._next_stages = next_stage._next_stages
+        Stage._links_version += 1
+        return True
@@ -1,12 +1,78 @@
 """Implements Stage class."""
 
+import collections
+import logging
 import multiprocessing
-from typing import Generic, Iterable, Self, TypeVar
+import os
+from multiprocessing.pool import AsyncResult, Pool, ThreadPool
+from typing import Any, Generic, Iterable, Self, TypeVar
 
 from mpipe_plus import Worker
-from mpipe_plus.work_exception import WorkException
+from mpipe_plus.Worker import (TAG_BATCH, TAG_DATA, TAG_STOP, TAG_WORK_EXC,
+                               _worker_entry, class_path, init_pool, pass_tube,
+                               tag_of)
+
+from .Tube import Tube
+from .tube_locked import TubeLocked
+from .tube_ring import ORDERED_MEMORY, TubeRing
+from .tube_rr import TubeRR
+from .tube_t import TubeT
+from .work_exception import WorkException
+
+logger = logging.getLogger(__name__)
+
+# Geometry of the rings made for single-producer tubes.
+_RING_SIZE = 1024
+_RING_SLOT_SIZE = 256
+
+# How many tasks an in-process input tube holds per worker, before producers wait.
+_TASKS_PER_WORKER = 16
+
+# How long the workers exiting after an error get to hand back their pool task,
+# in seconds, before the ones left are terminated.
+_EXIT_WAIT = 0.1
+
+# The lock of every stage's "stop" counter, made on first use
+# for each start method.
+_stop_locks = dict[str,Any]()
+
+
+def _get_stop_lock(context:multiprocessing.context.BaseContext):
+    """Return the lock shared by the "stop" counters of processes
+    started by *context*. Each lock is a semaphore to create, and the counters
+    are only updated once per worker, as the pipeline stops: one lock will do."""
+    start_method = context.get_start_method()
+    if start_method not in _stop_locks:
+        _stop_locks[start_method] = context.RLock()
+    return _stop_locks[start_method]
+
+
+def _key(synchronized:Any)->int|None:
+    """Return the key of a *synchronized* object for the workers, if any."""
+    return None if synchronized is None else id(synchronized)
+
+
+def _stop_pool(pool:Pool, results:list[AsyncResult]):
+    """Terminate the workers of *pool* after an error, but first wait for the ones
+    exiting on their own: killed midway through handing back their pool task,
+    they would hang the pool. Workers are done exiting once the *results*
+    of their tasks are ready, and left running once none gets ready in time."""
+    pending = [result for result in results if not result.ready()]
+    while pending:
+        pending[0].wait(_EXIT_WAIT)
+        running = [result for result in pending if not result.ready()]
+        if len(running) == len(pending):
+            break
+        pending = running
+    pool.terminate()
+
+
+def _available_cpus()->list[int]:
+    """Return the CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
 
-from .tube import Tube
 
 T = TypeVar('T')
 Q = TypeVar('Q')
@@ -16,6 +82,9 @@ Z = TypeVar('Z')
 class Stage(Generic[T, Q]):
     """The Stage is an assembly of workers of identical functionality."""
 
+    # Bumped whenever stages are linked: leaves found before may be stale.
+    _links_version = 0
+
     def __init__(
         self, 
         worker_class, 
@@ -23,9 +92,15 @@ class Stage(Generic[T, Q]):
         multi_process=True,
         disable_result=False,
         # do_stop_task=False, 
-        input_tube:Tube[tuple[tuple[int,T|Exception],int]]|None=None,
+        input_tube:Tube[tuple[int,Any,T|BaseException,int]]|None=None,
         name=None,
         show_time=False,
+        batch_size=1,
+        batch_timeout=0.005,
+        cpu_affinity:list[list[int]]|bool|None=None,
+        prefetch=0,
+        start_method:str|None=None,
+        ring=False,
         **worker_args
         ):
         """Create a stage of workers of given *worker_class* implementation, 
@@ -40,42 +115,175 @@ class Stage(Generic[T, Q]):
         it handles the ``None`` value as well. This will be
         the worker's final task before the process exits.
         
+        With *batch_size* > 1, each worker gathers up to that many tasks,
+        waiting at most *batch_timeout* seconds after the first one,
+        and publishes their results together.
+
+        *cpu_affinity* pins each worker process to a set of CPUs:
+        either a list of CPU sets (one per worker, in turn), or ``True`` to pin
+        the workers of consecutive stages to consecutive CPUs, one each,
+        so that producer and consumer share caches. It defaults to ``True``
+        for a *worker_class* with :attr:`Worker.pin_affinity` set.
+
+        With *prefetch* > 0, each worker reads up to that many tasks ahead
+        on a thread, receiving the next task while doTask() runs.
+        It has no effect with *batch_size* > 1.
+
+        *start_method* is the :mod:`multiprocessing` start method of the worker
+        processes, e.g. ``'forkserver'``, instead of the platform's default.
+
+        With *ring*, a stage fed by a single producer receives its tasks on
+        shared memory rings (see :class:`TubeRing`), one per worker fed round-robin,
+        sparing the system calls of a pipe; so does the pipeline receive the results
+        of a last stage of one worker. A ring holds its shared memory as long
+        as the stage exists, and round-robin leaves idle workers unable to take
+        the tasks of busy ones. Rings are only used on CPUs they are safe on,
+        see :data:`tube_ring.ORDERED_MEMORY`: elsewhere *ring* has no effect.
+
         Any worker initialization arguments are given in *worker_args*."""
         self._worker_class = worker_class
         self._worker_args = worker_args
         self._num_worker = num_worker
         self._disable_result = disable_result
         # self._do_stop_task = do_stop_task
-        self._input_tube:Tube[tuple[tuple[int,T|Exception],int]] = self._worker_class.getTubeClass()() \
-                           if not input_tube else input_tube
-        self._output_tubes = list[Tube[tuple[tuple[int,Q|Exception],int]]]()
+        self.multi_process=multi_process
+        # Whether any upstream stage runs its workers in other processes.
+        self._fed_by_process=False
+        # Number of upstream workers; the pipeline feeds a stage without any.
+        self._num_producers=0
+        self._ring=ring
+        # Whether the input tube was given rather than created by the stage.
+        self._given_input = input_tube is not None
+        if input_tube:
+            self._shared_input = True
+            self._worker_tubes = [input_tube]
+            self._input_tube:Tube[tuple[int,Any,T|BaseException,int]] = input_tube
+        else:
+            self._create_input_tubes()
+        self._start_method=start_method
+        self._stop_counter:Any = None
+        self._get_lock:Any = None
+        self._put_lock:Any = None
+        self._result_tube:Tube[tuple[int,Any,Q|BaseException,int]]|None = None
+        self._result_lock:Any = None
+        self._output_tubes = list[Tube[tuple[int,Any,Q|BaseException,int]]]()
+        # The pool tasks running the stage's workers, and all the ones of its pool.
+        self._worker_results = list[AsyncResult]()
+        self._pool_results = self._worker_results
         self.show_time=show_time
         self._next_stages = list[Stage]()
+        self._leaves:tuple[int,list[Stage]]|None = None
         self.name=name or self._worker_class.__name__
-        self.multi_process=multi_process
-        
-    def put(self, task:tuple[int,T|Exception]):
-        """Put *task* on the stage's input tube."""
+        self._batch_size=batch_size
+        self._batch_timeout=batch_timeout
+        self._cpu_affinity=cpu_affinity
+        if cpu_affinity is None and worker_class.pin_affinity:
+            self._cpu_affinity=True
+        self._prefetch=prefetch
+        self._pending=collections.deque[tuple[int,Q]]()
         
-        self._input_tube.put((task,0))
+    def prepare(self, context:multiprocessing.context.BaseContext)->dict[int,Any]:
+        """Create what the stage's workers share, for processes started by *context*:
+        the count of stopped workers, and the locks to take turns on tubes
+        shared with other processes. Return these synchronized objects keyed on id,
+        along with the stage's tubes that processes only inherit."""
+        self._stop_counter = context.Value('i', 0, lock=_get_stop_lock(context))
+        synchronized = {id(self._stop_counter):self._stop_counter}
+        def new_lock(needed:bool)->Any:
+            if not needed:
+                return None
+            lock = context.Lock()
+            synchronized[id(lock)] = lock
+            return lock
+        tube = self._input_tube
+        self._get_lock = new_lock(self._shared_input and self._num_worker > 1
+                                  and not tube.concurrent_get)
+        self._put_lock = new_lock(self._num_producers > 1 and not tube.concurrent_put)
+        if not self._next_stages:
+            # The stage's results are read by the pipeline from a tube of their own.
+            self._result_tube = self._new_tube(not self.multi_process, self._num_worker == 1)
+            self._result_lock = new_lock(self._num_worker > 1
+                                         and not self._result_tube.concurrent_put)
+        for tube in (*self._worker_tubes, self._input_tube, self._result_tube):
+            if tube is not None and tube.inherited:
+                synchronized[id(tube)] = tube
+        return synchronized
+
+    def _new_tube(self, in_process:bool, single_producer:bool, maxsize:int=0)->Tube:
+        """Return a new tube, passing items by reference if *in_process*,
+        at most *maxsize* of them if given.
+        With the stage's *ring* option, and unless the worker class picks its own tube,
+        a tube with a *single_producer* is a shared memory ring."""
+        if in_process:
+            return TubeT(maxsize)
+        if self._ring and ORDERED_MEMORY and single_producer and self._worker_class.getTubeClass is Worker.getTubeClass:
+            return TubeRing(size=_RING_SIZE, slot_size=_RING_SLOT_SIZE)
+        return self._worker_class.getTubeClass()()
+
+    def _create_input_tubes(self):
+        """Create the input tube shared by the workers, so that an idle worker
+        takes the next task whichever worker is busy.
+        Threads fed by the pipeline or by other threads only need an in-process tube,
+        bounded so that producers don't run ahead of the workers.
+        A ring has a single consumer: each worker then gets a ring of its own,
+        fed round-robin by the upstream producer."""
+        in_process = not self.multi_process and not self._fed_by_process
+        single_producer = self._num_producers <= 1
+        tube = self._new_tube(in_process, single_producer, _TASKS_PER_WORKER*self._num_worker)
+        self._worker_tubes:list[Tube[tuple[int,Any,T|BaseException,int]]] = [tube]
+        if isinstance(tube, TubeRing) and self._num_worker > 1:
+            self._worker_tubes += [self._new_tube(in_process, single_producer)
+                                   for _ in range(self._num_worker-1)]
+            self._input_tube = TubeRR(self._worker_tubes)
+            self._shared_input = False
+        else:
+            self._input_tube = tube
+            self._shared_input = self._num_worker > 1
+
+    def put(self, task:tuple[int,T]|tuple[tuple[int,...],tuple[T,...]], tag:int=TAG_DATA):
+        """Put *task* on the stage's input tube.
+        A task may also be a micro-batch of ``(task_indices, tasks)`` tuples,
+        tagged :data:`TAG_BATCH`."""
+        task_index,data = task
+        self._input_tube.put((tag,task_index,data,0))
+
+    def flush(self):
+        """Publish tasks buffered by the stage's input tube."""
+        self._input_tube.flush()
+
+    def broadcast(self, task:tuple[int,BaseException]):
+        """Put the control message *task* on the stage's input tube,
+        for every worker, and publish it right away."""
+        task_index,data = task
+        self._input_tube.broadcast((tag_of(data),task_index,data,0))
+        self._input_tube.flush()
 
     def get(self, timeout:float|None=None)->tuple[int,Q]:
         """Retrieve results from all the output tubes."""
-        for out in list(self.available_output_tubes):
-            task_index,result = out.get(timeout)[0]
-            if isinstance(result, StopIteration):
-                self.available_output_tubes.remove(out)
+        if self._pending:
+            return self._pending.popleft()
+        # Results are read from the first tube still open; stopped tubes
+        # are swap-removed so no copy of the list is needed.
+        tubes = self.available_output_tubes
+        while tubes:
+            tag,task_index,result,_ = tubes[0].get(timeout)
+            if tag == TAG_DATA:
+                return task_index,result
+            if tag == TAG_BATCH:
+                # A micro-batch of results: hand them out one at a time.
+                self._pending.extend(zip(task_index,result))
+                return self._pending.popleft()
+            if tag == TAG_STOP:
+                tubes[0] = tubes[-1]
+                tubes.pop()
                 continue
-            if isinstance(result, WorkException):
-                self.workers_pool.terminate()
+            _stop_pool(self.workers_pool, self._pool_results)
+            if tag == TAG_WORK_EXC:
                 result.re_raise()
-            
-            if isinstance(result, Exception):
-                self.workers_pool.terminate()
-                raise result
-            return task_index,result
+            raise result
 
-        self.workers_pool.join()
+        if self._own_pool:
+            self.workers_pool.join()
         raise StopIteration()
         
 
@@ -88,60 +296,137 @@ class Stage(Generic[T, Q]):
             pass
 
     def link(self, next_stage:"Stage[Q,Z]")  -> Self:
-        """Link to the given downstream stage *next_stage*
-        by adding its input tube to the list of this stage's output tubes.
+        """Link to the given downstream stage *next_stage*,
+        whose input tube becomes one of this stage's output tubes on build.
         Return this stage."""
         if next_stage is self: raise ValueError('cannot link stage to itself')
-        self._output_tubes.append(next_stage._input_tube)
+        recreate = False
+        if self.multi_process and not next_stage._fed_by_process:
+            # Results will come from other processes: in-process tubes won't do.
+            next_stage._fed_by_process = True
+            recreate = True
+        if next_stage._num_producers <= 1 < next_stage._num_producers + self._num_worker:
+            # Single-producer tubes won't do either.
+            recreate = True
+        next_stage._num_producers += self._num_worker
+        if recreate and not next_stage._given_input:
+            next_stage._create_input_tubes()
         self._next_stages.append(next_stage)
+        Stage._links_version += 1
         return self
 
     def get_leaves(self)->list["Stage"]:
         """Return the downstream leaf stages of this stage."""
+        if self._leaves is not None and self._leaves[0] == Stage._links_version:
+            return list(self._leaves[1])
         result = list[Stage]()
-        if not self._next_stages:
-            result.append(self)
-        else:
-            for stage in self._next_stages:
-                leaves = stage.get_leaves()
-                result += leaves
+        stack = [self]
+        while stack:
+            stage = stack.pop()
+            if not stage._next_stages:
+                result.append(stage)
+            else:
+                stack += reversed(stage._next_stages)
+        self._leaves = (Stage._links_version, result)
+        return list(result)
+
+    def get_stages(self)->list["Stage"]:
+        """Return this stage and all the stages downstream of it."""
+        result = list[Stage]()
+        stack = [self]
+        while stack:
+            stage = stack.pop()
+            if stage not in result:
+                result.append(stage)
+                stack += reversed(stage._next_stages)
         return result
 
-    def build(self):
-        """Create and start up the internal workers."""
+    def assign_cpus(self, first_cpu:int)->int:
+        """Resolve ``cpu_affinity=True`` by pinning the workers to consecutive
+        CPUs, starting at *first_cpu*. Return the CPU to start the next stage at."""
+        if self._cpu_affinity is not True:
+            return first_cpu
+        cpus = _available_cpus()
+        self._cpu_affinity = [[cpus[(first_cpu+i) % len(cpus)]] for i in range(self._num_worker)]
+        return first_cpu + self._num_worker
 
-        # If there's no output tube, it means that this stage
-        # is at the end of a fork (hasn't been linked to any stage downstream).
-        # Therefore, create one output tube.
-        if not self._output_tubes:
-            self._output_tubes.append(self._worker_class.getTubeClass()())
+    def build(self, pools:dict[bool,Pool]|None=None):
+        """Create and start up the internal workers.
+        Workers run on the given *pools*, keyed on :attr:`multi_process`,
+        set up with the stages' synchronized objects (see :meth:`prepare`);
+        without *pools* this stage and the downstream ones create pools of their own."""
+        if pools is not None:
+            self._build(pools, None, None)
+            return
+        context = multiprocessing.get_context(self._start_method)
+        synchronized = dict[int,Any]()
+        for stage in self.get_stages():
+            synchronized.update(stage.prepare(context))
+        self._build(None, context, synchronized)
+
+    def _build(self, pools:dict[bool,Pool]|None,
+               context:multiprocessing.context.BaseContext|None,
+               synchronized:dict[int,Any]|None):
+        """Start up the workers of this stage and the downstream ones, on *pools*
+        or else on pools of their own, of *context* and set up with *synchronized*."""
+        if self._next_stages:
+            self._output_tubes = [stage._input_tube for stage in self._next_stages]
+            put_locks = [stage._put_lock for stage in self._next_stages]
+        else:
+            # If there's no output tube, it means that this stage
+            # is at the end of a fork (hasn't been linked to any stage downstream).
+            # Therefore, use the tube read by the pipeline.
+            self._output_tubes = [self._result_tube]
+            put_locks = [self._result_lock]
+        self._out_locks = put_locks
 
-        
         # Create the workers.
-        print("num_worker",self._num_worker)
-        if self.multi_process:
-            self.workers_pool = multiprocessing.Pool(self._num_worker)
+        logger.debug("%s: num_worker %d", self.name, self._num_worker)
+        self._own_pool = pools is None
+        if pools is not None:
+            self.workers_pool = pools[self.multi_process]
         else:
-            from multiprocessing.pool import ThreadPool
-            self.workers_pool = ThreadPool(self._num_worker)
+            pool_class = context.Pool if self.multi_process else ThreadPool
+            self.workers_pool = pool_class(self._num_worker, initializer=init_pool,
+                                           initargs=(synchronized,))
+        self.assign_cpus(0)
         for i in range(self._num_worker):
-            self.workers_pool.apply_async(self._worker_class.process,kwds=dict(
-                input_tube=self._input_tube,
-                output_tubes=self._output_tubes,
+            self._worker_results.append(self.workers_pool.apply_async(_worker_entry,kwds=dict(
+                cls_path=class_path(self._worker_class),
+                input_tube=pass_tube(self._worker_tubes[i % len(self._worker_tubes)]),
+                relay_tube=pass_tube(self._input_tube) if self._shared_input else None,
+                stop_counter=id(self._stop_counter),
+                output_tubes=[pass_tube(tube) for tube in self._output_tubes],
                 index=i,
                 num_workers=self._num_worker,
                 disable_result=self._disable_result,
                 worker_args=self._worker_args,
                 name=self.name,
-                show_time=self.show_time))
+                show_time=self.show_time,
+                batch_size=self._batch_size,
+                batch_timeout=self._batch_timeout,
+                cpu_set=self._cpu_affinity[i % len(self._cpu_affinity)] if self._cpu_affinity else None,
+                prefetch=self._prefetch,
+                get_lock=_key(self._get_lock),
+                put_locks=[_key(lock) for lock in put_locks]),
+                error_callback=self._worker_failed))
         # self.workers_pool.map_async(_worker_process2,range(self._num_worker))
-        self.workers_pool.close()
+        if self._own_pool:
+            self.workers_pool.close()
         # self.workers_pool.join()
         # self.workers_pool.
                 # Build all downstream stages.
         for stage in self._next_stages:
-            stage.build()
+            stage._build(pools, context, synchronized)
         self.available_output_tubes = list(self._output_tubes)
 
+    def _worker_failed(self, error:BaseException):
+        """Pass on the *error* of a worker that could not be started or set up,
+        as the worker would have, so that reading results raises it."""
+        logger.error("%s: worker failed: %r", self.name, error)
+        message = (TAG_WORK_EXC, -1, WorkException(error, self.name, None), 0)
+        for tube,lock in zip(self._output_tubes, self._out_locks):
+            tube = tube if lock is None else TubeLocked(tube, put_lock=lock)
+            tube.put(message)
+            tube.flush()
     
-    
\ No newline at end of file
@@ -1,20 +1,61 @@
 """Implements TubeP class."""
 
 import abc
+import multiprocessing
+import pickle
+import queue
+import time
 from typing import Generic, TypeVar
 T = TypeVar('T')
 
 class Tube(abc.ABC,Generic[T]):
+    # Whether items are passed by reference, to threads of the same process.
+    in_process = False
+    # Whether consumers, or producers, sharing the tube may get, or put,
+    # items at the same time rather than taking turns.
+    concurrent_get = False
+    concurrent_put = False
+    # Whether the tube reaches other processes only as they start, like a lock:
+    # pools then receive it on startup rather than along with the tasks.
+    inherited = False
+
     @abc.abstractmethod
     def put(self, data:T):
         """Put an item on the tube."""
         pass
 
+    def put_raw(self, payload:bytes):
+        """Put an item, already pickled into *payload*, on the tube."""
+        self.put(pickle.loads(payload))
+
+    def broadcast(self, data:T):
+        """Put a control item on the tube for every consumer.
+        Consumers sharing a single tube pass it on to each other."""
+        self.put(data)
+
     @abc.abstractmethod
     def get(self, timeout:float|None=None)->T:
         """Return the next available item from the tube."""
         pass
 
+    def get_batch(self, max_n:int, timeout:float)->list[T]:
+        """Return up to *max_n* items from the tube.
+
+        Blocks until an item is available, then keeps collecting
+        the items arriving within *timeout* seconds."""
+        items = [self.get()]
+        deadline = time.monotonic() + timeout
+        while len(items) < max_n:
+            try:
+                items.append(self.get(max(deadline - time.monotonic(), 0)))
+            except (multiprocessing.TimeoutError, queue.Empty):
+                break
+        return items
+
+    def flush(self):
+        """Publish any items buffered by :meth:`put`."""
+        pass
+
     @abc.abstractmethod
     def close(self):
         """Close the tube."""
@@ -1,19 +1,113 @@
 """Implements UnorderedWorker class."""
 
 import abc
+import array
+import importlib
+import logging
 import multiprocessing
-from typing import Generic, TypeVar
+import os
+import pickle
+import queue
+import threading
+from time import perf_counter_ns
+from typing import Any, Generic, TypeVar
 
 from mpipe_plus.tube_p import TubeP
 
-from .tube import Tube
+from .Tube import Tube
 from .timer import Timer
 from .work_exception import WorkException
+from .tube_locked import TubeLocked
 from .tube_q import TubeQ
 
+logger = logging.getLogger(__name__)
+
 T = TypeVar('T')
 Q = TypeVar('Q')
 
+# Indices of the timing statistics a worker keeps when *show_time* is set.
+IDX_INIT, IDX_TASK, IDX_DISPOSE, IDX_IN, IDX_OUT = range(5)
+# Tags of the tube messages ``(tag, task_index, task, count)``, telling
+# tasks from control messages without isinstance() checks on every task.
+# A micro-batch carries a tuple of task indices and a tuple of tasks.
+TAG_DATA, TAG_STOP, TAG_WORK_EXC, TAG_EXC, TAG_BATCH = range(5)
+_TIMERS = (
+    Timer("init"),
+    Timer("perTask",per_item=True),
+    Timer("dispose"),
+    Timer("avg_in_wait",per_item=True),
+    Timer("avg_out_wait",disable=True,per_item=True),
+)
+
+# How often a thread reading tasks ahead checks that its worker still runs, in seconds.
+_PREFETCH_POLL = 0.1
+
+# The stages' "stop" counters, tube locks and inherited tubes, keyed on id. Synchronized
+# objects can't be pickled along with a task, so pools receive them on startup.
+# They are kept by each thread of the pool running workers: thread pools
+# sharing a process don't see each other's, nor keep them once done.
+_pool_state = threading.local()
+
+
+def init_pool(synchronized:dict[int,Any]):
+    """Pool initializer registering the stages' synchronized objects."""
+    _pool_state.synchronized = synchronized
+
+
+class _Inherited:
+    """Stands in for a tube received by the pool on startup, see :attr:`Tube.inherited`."""
+    __slots__ = ('key',)
+
+    def __init__(self, tube:Tube):
+        self.key = id(tube)
+
+
+def pass_tube(tube:Tube|None)->Tube|_Inherited|None:
+    """Return what to pass a worker along with its task for *tube*."""
+    return _Inherited(tube) if tube is not None and tube.inherited else tube
+
+
+def _received(tube:Tube|_Inherited|None, synchronized:dict[int,Any])->Tube|None:
+    """Return the tube passed to a worker by :func:`pass_tube`."""
+    return synchronized[tube.key] if isinstance(tube, _Inherited) else tube
+
+
+def tag_of(task)->int:
+    """Return the tag of the message carrying the single *task*."""
+    if isinstance(task, StopIteration):
+        return TAG_STOP
+    if isinstance(task, WorkException):
+        return TAG_WORK_EXC
+    if isinstance(task, BaseException):
+        return TAG_EXC
+    return TAG_DATA
+
+
+def class_path(cls:type)->str:
+    """Return the path of *cls* to resolve in the worker."""
+    return f'{cls.__module__}:{cls.__qualname__}'
+
+
+def _import(path:str)->type:
+    module, _, qualname = path.partition(':')
+    obj = importlib.import_module(module)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+def _worker_entry(cls_path:str, worker_args, **kwargs):
+    """Pool task running a worker of the class at *cls_path*."""
+    try:
+        instance=_import(cls_path)(**worker_args)
+        instance.init2(**kwargs)
+        instance.run()
+    except Exception as e:
+        print("Exception in worker init:",e)
+        import traceback
+        traceback.print_exception(e)
+        raise
+
 class Worker(abc.ABC, Generic[T, Q]):
     """An UnorderedWorker object operates independently of other
     workers in the stage, fetching the first available task, and
@@ -22,132 +116,375 @@ class Worker(abc.ABC, Generic[T, Q]):
     Consequently, the order of output results may not match 
     that of corresponding input tasks."""
 
+    # Set in a subclass to pin its workers to CPUs of their own by default,
+    # as with ``cpu_affinity=True`` on their stage.
+    pin_affinity = False
+
     def __init__(self):
         pass
 
     def init2(
         self, 
-        input_tube:Tube[tuple[tuple[int,T|BaseException],int]],      # Read task from the input tube.
-        output_tubes:list[Tube[tuple[tuple[int,Q|BaseException],int]]],    # Send result on all the output tubes.
+        input_tube:Tube[tuple[int,Any,T|BaseException,int]],      # Read task from the input tube.
+        relay_tube:Tube[tuple[int,Any,T|BaseException,int]]|None,      # Pass "stop" on to the other workers.
+        stop_counter:int,     # Key of the stage's count of stopped workers.
+        output_tubes:list[Tube[tuple[int,Any,Q|BaseException,int]]],    # Send result on all the output tubes.
         num_workers:int,     # Total number of workers in the stage.
         disable_result:bool,  # Whether to override any result with None.
         name:str,
         index:int,
-        show_time:bool
+        show_time:bool,
+        batch_size:int=1,     # Max number of tasks to process as one micro-batch.
+        batch_timeout:float=0.0,    # How long to wait for a micro-batch to fill up.
+        cpu_set:list[int]|None=None,    # CPUs to pin the worker to.
+        prefetch:int=0,     # Number of tasks to read ahead on a thread.
+        get_lock:int|None=None,     # Key of the lock to take turns getting from the input tube.
+        put_locks:list[int|None]|None=None     # Keys of the locks to take turns putting on the output tubes.
         ):
         """Create *num_workers* worker objects with *input_tube* and 
         an iterable of *output_tubes*. The worker reads a task from *input_tube* 
-        and writes the result to *output_tubes*."""
+        and writes the result to *output_tubes*.
+        Every worker receives its own "stop" request, unless the workers share
+        *input_tube*: then the request is passed on to the others on *relay_tube*."""
 
         super(Worker, self).__init__()
+        synchronized = _pool_state.synchronized
+        input_tube = _received(input_tube, synchronized)
+        relay_tube = _received(relay_tube, synchronized)
+        output_tubes = [_received(tube, synchronized) for tube in output_tubes]
+        # Tubes shared with other processes are used in turns, under their locks.
+        if get_lock is not None:
+            input_tube = TubeLocked(input_tube, get_lock=synchronized[get_lock])
+        if put_locks:
+            output_tubes = [tube if key is None else TubeLocked(tube, put_lock=synchronized[key])
+                            for tube,key in zip(output_tubes, put_locks)]
         self.show_time=show_time
         self.name=name
         self.index=index
-        self.process_executed={
-            "doInit":Timer("init"),
-            "doTask":Timer("perTask",per_item=True),
-            "doDispose":Timer("dispose"),
-            "task_get_input":Timer("avg_in_wait",per_item=True),
-            "task_put_output":Timer("avg_out_wait",disable=True,per_item=True),
-        }
+        # Formatted once: errors of the worker's tasks are labeled with it.
+        self._repr=f"{name}[{index}]"
+        # Accumulated nanoseconds and counts, indexed by the IDX_* constants.
+        self._acc = array.array('q', [0]*len(_TIMERS))
+        self._cnt = array.array('Q', [0]*len(_TIMERS))
         self._tube_task_input = input_tube
+        self._tube_task_relay = relay_tube
+        self._stop_counter = synchronized[stop_counter]
         self._tubes_result_output = output_tubes
+        # Bound put methods of the output tubes, resolved once: by reference
+        # for in-process tubes, and pickled ones for the others when fanning out.
+        if len(output_tubes) == 1:
+            self._put_outs = (output_tubes[0].put,)
+            self._put_raws = ()
+        else:
+            self._put_outs = tuple(tube.put for tube in output_tubes if tube.in_process)
+            self._put_raws = tuple(tube.put_raw for tube in output_tubes if not tube.in_process)
         self._num_workers = num_workers
         self._disable_result = disable_result
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._cpu_set = cpu_set
+        self._prefetch = prefetch
+        # Set to stop the thread reading tasks ahead, along with the thread.
+        self._prefetcher:tuple[threading.Event,threading.Thread]|None = None
+        self._held_tasks = list[tuple[int,Any,T|BaseException,int]]()
         
     @staticmethod
     def getTubeClass():
         """Return the tube class implementation."""
-        return TubeP[tuple[tuple[int,T],int]|None]
+        return TubeP[tuple[int,Any,T,int]]
     
 
 
-    def putResult(self, task_index, result:Q|BaseException):
-        """Register the *result* by putting it on all the output tubes."""
+    def putResult(self, task_index, result:Q|BaseException, tag:int=TAG_DATA):
+        """Register the *result* by putting it on all the output tubes.
+        A *result* that is not data needs its *tag*, see :func:`tag_of`."""
+        item = (tag, task_index, result, 0)
+        for put in self._put_outs:
+            put(item)
+        if self._put_raws:
+            # Fanning out: pickle the result once for all the tubes that need it.
+            payload = pickle.dumps(item, protocol=5)
+            for put_raw in self._put_raws:
+                put_raw(payload)
+
+    def broadcastResult(self, task_index, result:BaseException):
+        """Put the control message *result* on all the output tubes,
+        for every downstream worker, and publish it right away."""
         for tube in self._tubes_result_output:
-            tube.put(((task_index,result), 0))
+            tube.broadcast((tag_of(result), task_index, result, 0))
+        self.flushResults()
 
     @classmethod
     def process(cls,worker_args,**kwargs):
-        try:
-            instance=cls(**worker_args)
-            instance.init2(**kwargs)
-            instance.run()
-        except Exception as e:
-            print("Exception in worker init:",e)
-            import traceback
-            traceback.print_exception(e)
-            raise
+        _worker_entry(class_path(cls),worker_args,**kwargs)
 
     def run(self):
+        if self._cpu_set and hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(0, self._cpu_set)
+            except OSError as e:
+                logger.warning("Cannot pin worker to CPUs %s: %s", self._cpu_set, e)
         try:
             # Run implementation's initialization.
-            with self.process_executed["doInit"]:
-                self.doInit()
-        
+            t0 = perf_counter_ns()
+            self.doInit()
+            self._addTime(IDX_INIT, t0)
+
+            # Bind to locals what the loop looks up on every task.
+            if self._batch_size > 1:
+                get_task = self._getBatch
+            elif self._prefetch > 0:
+                get_task = self._startPrefetch()
+            else:
+                get_task = self._tube_task_input.get
+            do_task = self.doTask
+            put_result = self.putResult
+            disable_result = self._disable_result
+            show_time = self.show_time
+            # The output wait isn't shown by default: don't time it then.
+            time_out = show_time and not _TIMERS[IDX_OUT].disable
+            acc = self._acc
+            cnt = self._cnt
             while True:
                 try:
-                    (task_index,task), count = self._tube_task_input.get()
+                    if show_time:
+                        t0 = perf_counter_ns()
+                        tag, task_index, task, count = get_task()
+                        acc[IDX_IN] += perf_counter_ns() - t0
+                        cnt[IDX_IN] += 1
+                    else:
+                        tag, task_index, task, count = get_task()
                 except Exception as e:
-                    (task_index,task), count = ((-1,e), 0)
-
-                # In case the task is None, it represents the "stop" request,
-                # the count being the number of workers in this stage that had
-                # already stopped.
-                if isinstance(task, StopIteration) :
-                    # If this worker is the last one (of its stage) to receive the 
-                    # "stop" request, propagate "stop" to the next stage. Otherwise,
-                    # maintain the "stop" signal in this stage for another worker that
-                    # will pick it up. 
-                    count += 1
-                    if count == self._num_workers:
-                        self.putResult(task_index,task)
+                    tag, task_index, task, count = tag_of(e), -1, e, 0
+
+                if tag != TAG_DATA:
+                    if tag == TAG_BATCH:
+                        # A micro-batch of tasks, see Pipeline.put_batch().
+                        if not self._doBatch(task_index,task):
+                            break
+                        continue
+                    # A "stop" request.
+                    if tag == TAG_STOP:
+                        # If this worker is the last one (of its stage) to stop,
+                        # propagate "stop" to the next stage. Otherwise, leave
+                        # the "stop" signal for the workers sharing the input tube.
+                        with self._stop_counter.get_lock():
+                            self._stop_counter.value += 1
+                            is_last = self._stop_counter.value == self._num_workers
+                        if is_last:
+                            self.broadcastResult(task_index,task)
+                        else:
+                            # Publish this worker's results still buffered by the output tubes.
+                            self.flushResults()
+                            if self._tube_task_relay is not None:
+                                self._tube_task_relay.put((tag, task_index, task, 0))
+                                self._tube_task_relay.flush()
+
+                        # Honor the "stop" request by exiting the process.
+                        break  
+                    if tag == TAG_WORK_EXC:
+                        put_result(task_index,task,TAG_WORK_EXC)
+                        self.close_pipes()
+                        break
+                    if self._tube_task_relay is not None:
+                        self._tube_task_relay.put((tag, task_index, task, 0))
+                        self._tube_task_relay.flush()
+                    raise task
+                # The task is not a control message, meaning that it is an actual task to
+                # be processed. Therefore let's call doTask().
+                try:
+                    if show_time:
+                        t0 = perf_counter_ns()
+                        result = do_task(task)
+                        acc[IDX_TASK] += perf_counter_ns() - t0
+                        cnt[IDX_TASK] += 1
                     else:
-                        self._tube_task_input.put(((task_index,task), count))
-
-                    # In case we're calling doTask() on a "stop" request, do so now.
-                
-                    # Honor the "stop" request by exiting the process.
-                    break  
-                if isinstance(task, WorkException):
-                    self.putResult(task_index,task)
+                        result = do_task(task)
+                except Exception as e:
+                    put_result(task_index,WorkException(e, self, task),TAG_WORK_EXC)
                     self.close_pipes()
                     break
-                if isinstance(task, BaseException):
-                    self._tube_task_input.put(((task_index,task), count+1))
-                    raise task
-                # The task is not None, meaning that it is an actual task to
-                # be processed. Therefore let's call doTask().
-                with self.process_executed["doTask"]:
-                    try:
-                        result = self.doTask(task)
-                    except Exception as e:
-                        self.putResult(task_index,WorkException(e, self, task))
-                        self.close_pipes()
-                        break
 
                 # Unless result is disabled,
                 # if doTask() actually returns a result (and the result is not None),
                 # it indicates that it did not call putResult(), instead intending
                 # it to be called now.
-                if not self._disable_result and result is not None:
-                    with self.process_executed['task_put_output']:
-                        self.putResult(task_index,result)
+                if not disable_result and result is not None:
+                    if time_out:
+                        t0 = perf_counter_ns()
+                        put_result(task_index,result)
+                        acc[IDX_OUT] += perf_counter_ns() - t0
+                        cnt[IDX_OUT] += 1
+                    else:
+                        put_result(task_index,result)
 
         except KeyboardInterrupt as e:
-            self.putResult(-1,e)
+            self.putResult(-1,e,TAG_EXC)
+            self.flushResults()
         except Exception as e:
-            self.putResult(-1,WorkException(e, self, None))
+            self.putResult(-1,WorkException(e, self, None),TAG_WORK_EXC)
             self.close_pipes()
         finally:
-            with self.process_executed['doDispose']:
-                self.doDispose()
+            self._stopPrefetch()
+            t0 = perf_counter_ns()
+            self.doDispose()
+            self._addTime(IDX_DISPOSE, t0)
             if self.show_time:
                 # avg_out_wait:{stats['task_put_output']/stats['task_count']:.2f}s
-                stats=" ".join(f"{str(v):>30}" for k,v in self.process_executed.items() if v.elapsed_time>.001)
-                print(f"[{self.index}]{str(self):<10}: {stats}")
+                stats=" ".join(f"{str(v):>30}" for v in self._timers() if v.elapsed_time>1_000_000)
+                print(f"{self._repr:<13}: {stats}")
+
+    def _addTime(self, idx:int, from_time:int):
+        """Account the time since *from_time* to the statistic *idx*."""
+        if self.show_time and not _TIMERS[idx].disable:
+            self._acc[idx] += perf_counter_ns() - from_time
+            self._cnt[idx] += 1
+
+    def _timers(self)->list[Timer]:
+        """Return the timing statistics as :class:`Timer` objects, for display."""
+        timers = list[Timer]()
+        for idx, proto in enumerate(_TIMERS):
+            timer = Timer(proto.name, disable=proto.disable, per_item=proto.per_item)
+            timer.elapsed_time = self._acc[idx]
+            timer.count = self._cnt[idx]
+            timers.append(timer)
+        return timers
+
+    def _startPrefetch(self):
+        """Start reading tasks from the input tube on a thread, so that the next
+        task is already received when doTask() returns. Return the function
+        getting the tasks read, at most *prefetch* of them ahead."""
+        tasks = queue.Queue[tuple[int,Any,T|BaseException,int]](self._prefetch)
+        get = self._tube_task_input.get
+        stop = threading.Event()
+        def read():
+            # Wait in rounds, to notice the worker stopping without a control message.
+            while not stop.is_set():
+                try:
+                    item = get(_PREFETCH_POLL)
+                except (multiprocessing.TimeoutError, queue.Empty):
+                    continue
+                except Exception as e:
+                    item = (tag_of(e), -1, e, 0)
+                while not stop.is_set():
+                    try:
+                        tasks.put(item, timeout=_PREFETCH_POLL)
+                        break
+                    except queue.Full:
+                        pass
+                # A control message is the last one for this worker.
+                if item[0] != TAG_DATA and item[0] != TAG_BATCH:
+                    break
+        thread = threading.Thread(target=read, name=f'{self.name}-prefetch', daemon=True)
+        thread.start()
+        self._prefetcher = (stop, thread)
+        return tasks.get
+
+    def _stopPrefetch(self):
+        """Stop reading tasks ahead, if doing so."""
+        if self._prefetcher is not None:
+            stop, thread = self._prefetcher
+            stop.set()
+            thread.join()
+            self._prefetcher = None
+
+    def _getBatch(self)->tuple[int,Any,Any,int]:
+        """Return the next message from the input tube, coalescing
+        the tasks that arrive within the batch timeout into a single micro-batch
+        of up to *batch_size* tasks. Control messages, and the tasks past
+        the micro-batch, are held back for the following calls."""
+        items = self._held_tasks
+        if not items:
+            items = self._tube_task_input.get_batch(self._batch_size, self._batch_timeout)
+        self._held_tasks = []
+        task_indices = list[int]()
+        tasks = list[T]()
+        room = self._batch_size
+        for i,(tag,task_index,task,count) in enumerate(items):
+            if tag == TAG_DATA:
+                task_indices.append(task_index)
+                tasks.append(task)
+            elif tag == TAG_BATCH:
+                task_indices += task_index[:room]
+                tasks += task[:room]
+                if len(task) > room:
+                    self._held_tasks = [(tag,task_index[room:],task[room:],count), *items[i+1:]]
+                    break
+            elif tasks:
+                self._held_tasks = items[i:]
+                break
+            else:
+                self._held_tasks = items[i+1:]
+                return tag,task_index,task,count
+            room = self._batch_size - len(tasks)
+            if not room:
+                self._held_tasks = items[i+1:]
+                break
+        return TAG_BATCH,tuple(task_indices),tuple(tasks),0
+
+    def _doBatch(self, task_indices:tuple[int,...], tasks:tuple[T,...])->bool:
+        """Call doTask() on every task of a micro-batch, or doTaskBatch()
+        if overridden, and put the results on the output tubes as a single batch.
+        Return ``False`` if a task failed and the worker should stop."""
+        result_indices=list[int]()
+        results=list[Q]()
+        error=None
+        show_time=self.show_time
+        if getattr(self.doTaskBatch, '__func__', None) is not Worker.doTaskBatch:
+            t0 = perf_counter_ns() if show_time else 0
+            try:
+                batch_results = self.doTaskBatch(tasks)
+            except Exception as e:
+                error=WorkException(e, self, tasks)
+                task_index=task_indices[0]
+            else:
+                if show_time:
+                    self._acc[IDX_TASK] += perf_counter_ns() - t0
+                    self._cnt[IDX_TASK] += len(tasks)
+                if not self._disable_result:
+                    for task_index,result in zip(task_indices,batch_results):
+                        if result is not None:
+                            result_indices.append(task_index)
+                            results.append(result)
+        else:
+            # Bind to locals what the loop looks up on every task.
+            do_task = self.doTask
+            keep_results = not self._disable_result
+            add_index = result_indices.append
+            add_result = results.append
+            t0 = perf_counter_ns() if show_time else 0
+            for task_index,task in zip(task_indices,tasks):
+                try:
+                    result = do_task(task)
+                except Exception as e:
+                    error=WorkException(e, self, task)
+                    break
+                if keep_results and result is not None:
+                    add_index(task_index)
+                    add_result(result)
+            if show_time:
+                # Time the tasks as a whole, counting those done.
+                self._acc[IDX_TASK] += perf_counter_ns() - t0
+                self._cnt[IDX_TASK] += len(tasks) if error is None \
+                                       else task_indices.index(task_index)
+        if results:
+            t0 = perf_counter_ns() if show_time else 0
+            self.putResult(tuple(result_indices),tuple(results),TAG_BATCH)
+            self._addTime(IDX_OUT, t0)
+        if error is not None:
+            self.putResult(task_index,error,TAG_WORK_EXC)
+            self.close_pipes()
+            return False
+        return True
+
+    def flushResults(self):
+        """Publish results buffered by the output tubes."""
+        for tube in self._tubes_result_output:
+            tube.flush()
 
     def close_pipes(self):
+        self._stopPrefetch()
+        self.flushResults()
         self._tube_task_input.close()
         for tube in self._tubes_result_output:
             tube.close()
@@ -161,6 +498,13 @@ class Worker(abc.ABC, Generic[T, Q]):
         2) returning the result (other than ``None``)."""
         
 
+    def doTaskBatch(self, tasks:tuple[T,...])->list[Q|None]:
+        """Return the results of all *tasks* of a micro-batch, in order,
+        ``None`` for a task without result.
+        Override this method to process a micro-batch at once (e.g. vectorized),
+        instead of calling :meth:`doTask` on each task."""
+        return [self.doTask(task) for task in tasks]
+
     def doInit(self):
         """Implement this method in the subclass in case there's need
         for additional initialization after process startup.
@@ -179,4 +523,4 @@ class Worker(abc.ABC, Generic[T, Q]):
         return None
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self._repr
\ No newline at end of file
@@ -7,10 +7,14 @@ from .Worker import Worker
 from .Stage import Stage
 # from .OrderedStage import OrderedStage
 from .SimpleStage import SimpleStage
-from .pipeline import Pipeline
+from .ReorderStage import ReorderStage
+from .Pipeline import Pipeline
 # from .old.FilterWorker import FilterWorker
 # from .old.FilterStage import FilterStage
 from .work_exception import WorkException
-from .tube import Tube
+from .Tube import Tube
 from .tube_p import TubeP
-from .tube_q import TubeQ
\ No newline at end of file
+from .tube_q import TubeQ
+from .tube_ring import TubeRing
+from .tube_rr import TubeRR
+from .tube_t import TubeT
@@ -4,30 +4,38 @@ import time
 
 
 class Timer:
+    """Accumulates the nanoseconds spent in a ``with`` block, and the number of times."""
+
+    # Set to False to skip timing altogether, e.g. in production.
+    enabled = True
 
     def __init__(self, name,disable=False,per_item=False):
         self.disable = disable
         self.name = name
-        self.elapsed_time =0.0
+        self.elapsed_time =0
         self.count = 0
         self.per_item = per_item
 
     def __enter__(self):
-        self.start_time = time.time()
+        # A disabled timer isn't shown: don't read the clock for it either.
+        if Timer.enabled and not self.disable:
+            self.start_time = time.perf_counter_ns()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.add_from_time(self.start_time)
+        if Timer.enabled and not self.disable:
+            self.add_from_time(self.start_time)
         
-    def add_from_time(self, from_time):
+    def add_from_time(self, from_time:int):
+        """Account the time since *from_time*, from :func:`time.perf_counter_ns`."""
         self.count += 1
-        self.elapsed_time += time.time()-from_time    
+        self.elapsed_time += time.perf_counter_ns()-from_time    
     def __str__(self):
         if self.disable:
             return ""
         # Convert to hours, minutes, seconds
 
-        per_item_time = self.elapsed_time/self.count if self.per_item else self.elapsed_time
+        per_item_time = (self.elapsed_time/self.count if self.per_item else self.elapsed_time)/1e9
         hours, remainder = divmod(per_item_time, 3600)
         minutes, seconds = divmod(remainder, 60)
         
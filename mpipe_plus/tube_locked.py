@@ -0,0 +1,52 @@
+"""Implements TubeLocked class."""
+
+import contextlib
+from typing import Any, TypeVar
+
+from .Tube import Tube
+
+T = TypeVar('T')
+
+
+class TubeLocked(Tube[T]):
+    """A tube shared by consumers, or producers, that must take turns on it,
+    e.g. several processes reading one pipe.
+
+    Items are got from *tube* holding *get_lock*, and put on it holding *put_lock*.
+    Workers wrap their tubes this way around the locks their pool received."""
+
+    def __init__(self, tube:Tube[T], get_lock:Any=None, put_lock:Any=None):
+        self._tube = tube
+        self.in_process = tube.in_process
+        self._get_lock = get_lock if get_lock is not None else contextlib.nullcontext()
+        self._put_lock = put_lock if put_lock is not None else contextlib.nullcontext()
+
+    def put(self, data:T):
+        """Put an item on the tube."""
+        with self._put_lock:
+            self._tube.put(data)
+
+    def put_raw(self, payload:bytes):
+        """Put an item, already pickled into *payload*, on the tube."""
+        with self._put_lock:
+            self._tube.put_raw(payload)
+
+    def broadcast(self, data:T):
+        with self._put_lock:
+            self._tube.broadcast(data)
+
+    def flush(self):
+        with self._put_lock:
+            self._tube.flush()
+
+    def get(self, timeout:float|None=None)->T:
+        """Return the next available item from the tube."""
+        with self._get_lock:
+            return self._tube.get(timeout)
+
+    def get_batch(self, max_n:int, timeout:float)->list[T]:
+        with self._get_lock:
+            return self._tube.get_batch(max_n, timeout)
+
+    def close(self):
+        self._tube.close()
@@ -1,32 +1,145 @@
 """Implements TubeP class."""
 
+import collections
+import mmap
 import multiprocessing
+import os
+import pickle
+import struct
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 from typing import Generic, TypeVar
 
-from .tube import Tube
+from .Tube import Tube
 T = TypeVar('T')
 
+# Buffers at least this large travel out-of-band in shared memory.
+_OOB_THRESHOLD = 64*1024
+# Length prefix of every item in a batch.
+_FRAME = struct.Struct('<I')
+
+
+class _OutOfBand:
+    """A protocol 5 pickle whose out-of-band buffers
+    were copied to shared memory blocks.
+
+    The blocks belong to the consumer, which removes them once loaded: they are
+    left out of the producer's resource tracker, lest it remove them as it exits."""
+
+    def __init__(self, data:bytes, buffers:list[pickle.PickleBuffer]):
+        self.data = data
+        self.blocks = list[tuple[str,int]]()
+        for buffer in buffers:
+            raw = buffer.raw()
+            shm = SharedMemory(create=True, size=max(raw.nbytes, 1))
+            shm.buf[:raw.nbytes] = raw
+            self.blocks.append((shm.name, raw.nbytes))
+            shm.close()
+            if os.name == 'posix':
+                resource_tracker.unregister(shm._name, 'shared_memory')
+
+    def load(self):
+        buffers = []
+        for name, size in self.blocks:
+            shm = SharedMemory(name)
+            try:
+                buffers.append(_map_block(shm, size))
+            finally:
+                shm.close()
+                shm.unlink()
+        return pickle.loads(self.data, buffers=buffers)
+
+
+def _map_block(shm:SharedMemory, size:int)->memoryview|bytearray:
+    """Return the first *size* bytes of *shm*, valid once *shm* is closed and unlinked.
+
+    Where the block has a file descriptor, it is mapped once more, privately:
+    objects loaded from the buffer (e.g. NumPy arrays) then share the mapping
+    instead of a copy, and it is released along with the last of them."""
+    fd = getattr(shm, '_fd', -1)
+    if fd < 0:
+        return bytearray(shm.buf[:size])
+    return memoryview(mmap.mmap(fd, max(size, 1)))[:size]
+
 
 class TubeP(Tube[T]):
     """A unidirectional communication channel 
     using :class:`multiprocessing.Connection` for underlying implementation."""
 
-    def __init__(self):
+    def __init__(self, batch:int=1):
+        """With *batch* > 1, the producer buffers pickled items and sends
+        every *batch* of them with a single write to the pipe.
+        Buffered items are sent by :meth:`flush`."""
+        if batch < 1:
+            raise ValueError('batch must be at least 1')
         (self._conn1, 
          self._conn2) = multiprocessing.Pipe(duplex=False)
+        self._batch = batch
+        # Pickled items buffered by the producer, and received by the consumer.
+        self._pending = list[bytes]()
+        self._received = collections.deque[memoryview]()
 
     def put(self, data:T):
-        """Put an item on the tube."""
-        self._conn2.send(data)
+        """Put an item on the tube.
+
+        Large buffers (e.g. NumPy arrays, :class:`pickle.PickleBuffer`) are pickled
+        out-of-band and passed through shared memory instead of the pipe."""
+        buffers = list[pickle.PickleBuffer]()
+        def buffer_callback(buffer:pickle.PickleBuffer):
+            if buffer.raw().nbytes < _OOB_THRESHOLD:
+                return True
+            buffers.append(buffer)
+            return False
+        payload = pickle.dumps(data, 5, buffer_callback=buffer_callback)
+        if buffers:
+            payload = pickle.dumps(_OutOfBand(payload, buffers), 5)
+        self.put_raw(payload)
+
+    def put_raw(self, payload:bytes):
+        """Put an item, already pickled into *payload*, on the tube."""
+        if self._batch == 1:
+            self._conn2.send_bytes(payload)
+            return
+        self._pending.append(_FRAME.pack(len(payload)))
+        self._pending.append(payload)
+        if len(self._pending) >= 2*self._batch:
+            self.flush()
+
+    def flush(self):
+        """Send the items put since the last write to the pipe."""
+        if self._pending:
+            self._conn2.send_bytes(b''.join(self._pending))
+            self._pending.clear()
 
     def get(self, timeout:float|None=None)->T:
         """Return the next available item from the tube.
 
         Blocks if tube is empty, until a producer for the tube puts an item on it."""
-        if self._conn1.poll(timeout):
-            return self._conn1.recv()
-        else:
-            raise multiprocessing.TimeoutError
+        if not self._received:
+            # recv_bytes() blocks anyway: only poll for a timeout.
+            if timeout is not None and not self._conn1.poll(timeout):
+                raise multiprocessing.TimeoutError
+            if self._batch == 1:
+                return self._load(self._conn1.recv_bytes())
+            self._split(self._conn1.recv_bytes())
+        return self._load(self._received.popleft())
+
+    def _split(self, blob:bytes):
+        """Queue the items of the batch *blob* as received."""
+        view = memoryview(blob)
+        offset = 0
+        while offset < len(view):
+            size = _FRAME.unpack_from(view, offset)[0]
+            offset += _FRAME.size
+            self._received.append(view[offset:offset+size])
+            offset += size
+
+    @staticmethod
+    def _load(payload:bytes|memoryview)->T:
+        data = pickle.loads(payload)
+        if type(data) is _OutOfBand:
+            data = data.load()
+        return data
 
     def close(self):
         self._conn1.close()
@@ -1,30 +1,145 @@
 """Implements TubeQ class."""
 
 import multiprocessing
+import pickle
+import queue
+import time
 from typing import TypeVar
 
-from .tube import Tube
+from .Tube import Tube
+
+try:
+    from faster_fifo import Queue as FastQueue
+except ImportError:
+    FastQueue = None
 
 T = TypeVar('T')
+
+# faster-fifo has no "block forever": wait in rounds of this many seconds.
+_FAST_WAIT = 1000.0
+# faster-fifo's length prefix of every message.
+_FAST_HEADER = 8
+
+
+def _pickled(payload:bytes)->bytes:
+    """Serializer of faster-fifo: items are put on it already pickled."""
+    return payload
+
+
 class TubeQ(Tube[T]):
-    """A unidirectional communication channel 
-    using :class:`multiprocessing.Queue` for underlying implementation."""
+    """A unidirectional communication channel
+    using :class:`multiprocessing.Queue` for underlying implementation.
+
+    Given *max_size_bytes*, an unbounded tube uses the queue of the optional
+    `faster-fifo <https://github.com/alex-petrenko/faster-fifo>`_ package
+    instead if it's installed, holding up to *max_size_bytes* of pickled items.
+    Putting a larger item on it raises :class:`ValueError`."""
 
-    def __init__(self, maxsize=0):
-        self._queue = multiprocessing.Queue(maxsize)
+    concurrent_get = True
+    concurrent_put = True
+    inherited = True
+
+    def __init__(self, maxsize=0, max_size_bytes:int|None=None):
+        self._fast = FastQueue is not None and not maxsize and max_size_bytes is not None
+        if self._fast:
+            self._max_size_bytes = max_size_bytes
+            self._queue = FastQueue(max_size_bytes=max_size_bytes, dumps=_pickled)
+        else:
+            self._queue = multiprocessing.Queue(maxsize)
 
     def put(self, data:T):
-        """Put an item on the tube."""
-        self._queue.put(data)
+        """Put an item on the tube.
+
+        Blocks if tube is full, until a consumer gets an item from it."""
+        if self._fast:
+            self._put_payloads([pickle.dumps(data, pickle.HIGHEST_PROTOCOL)])
+        else:
+            self._queue.put(data)
+
+    def put_raw(self, payload:bytes):
+        """Put an item, already pickled into *payload*, on the tube."""
+        if self._fast:
+            self._put_payloads([payload])
+        else:
+            super().put_raw(payload)
+
+    def put_many(self, items:list[T]):
+        """Put all *items* on the tube."""
+        if self._fast:
+            self._put_payloads([pickle.dumps(data, pickle.HIGHEST_PROTOCOL) for data in items])
+        else:
+            for data in items:
+                self._queue.put(data)
+
+    def _put_payloads(self, payloads:list[bytes]):
+        """Put the pickled *payloads* on the faster-fifo queue, as few
+        writes as fit in it, waiting as long as it takes for room."""
+        chunk = list[bytes]()
+        chunk_size = 0
+        for payload in payloads:
+            size = _FAST_HEADER + len(payload)
+            if size > self._max_size_bytes:
+                raise ValueError(f'item of {len(payload)} bytes pickled does not fit '
+                                 f'in a tube of max_size_bytes={self._max_size_bytes}')
+            if chunk_size + size > self._max_size_bytes:
+                self._put_chunk(chunk)
+                chunk = []
+                chunk_size = 0
+            chunk.append(payload)
+            chunk_size += size
+        if chunk:
+            self._put_chunk(chunk)
+
+    def _put_chunk(self, payloads:list[bytes]):
+        while True:
+            try:
+                return self._queue.put_many(payloads, timeout=_FAST_WAIT)
+            except queue.Full:
+                pass
 
     def get(self, timeout:float|None=None)->T:
         """Return the next available item from the tube.
 
         Blocks if tube is empty, until a producer for the tube puts an item on it."""
-        
-        return  self._queue.get(True, timeout)
-        
-        
+        if timeout is None:
+            if not self._fast:
+                return self._queue.get()
+            while True:
+                try:
+                    return self._queue.get(timeout=_FAST_WAIT)
+                except queue.Empty:
+                    pass
+        try:
+            return self._queue.get(True, timeout)
+        except queue.Empty:
+            raise multiprocessing.TimeoutError from None
+
+    def get_many(self, max_n:int, timeout:float|None=None)->list[T]:
+        """Return between one and *max_n* of the items available on the tube.
+
+        Blocks if tube is empty, until a producer for the tube puts an item on it."""
+        if not self._fast:
+            return [self.get(timeout)]
+        if timeout is None:
+            while True:
+                try:
+                    return self._queue.get_many(timeout=_FAST_WAIT, max_messages_to_get=max_n)
+                except queue.Empty:
+                    pass
+        return self._queue.get_many(timeout=timeout, max_messages_to_get=max_n)
+
+    def get_batch(self, max_n:int, timeout:float)->list[T]:
+        if not self._fast:
+            return super().get_batch(max_n, timeout)
+        items = self.get_many(max_n)
+        deadline = time.monotonic() + timeout
+        while len(items) < max_n:
+            try:
+                items += self.get_many(max_n - len(items), max(deadline - time.monotonic(), 0))
+            except (multiprocessing.TimeoutError, queue.Empty):
+                break
+        return items
 
     def close(self):
-        self._queue.close()
\ No newline at end of file
+        if not self._fast:
+            self._queue.close()
@@ -0,0 +1,351 @@
+"""Implements TubeRing class."""
+
+import collections
+import multiprocessing
+import os
+import pickle
+import platform
+import struct
+import time
+import weakref
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, TypeVar
+
+from .Tube import Tube
+
+T = TypeVar('T')
+
+_CACHE_LINE = 64
+# The head (consumer) and tail (producer) indices live on separate
+# cache lines so that producer and consumer don't invalidate each other's line.
+_HEAD = 0
+_TAIL = _CACHE_LINE
+_SLOTS = 2 * _CACHE_LINE
+
+_INDEX = struct.Struct('Q')
+# Set by the producer once any payload spilled, on the producer's cache line.
+_SPILLED = _TAIL + _INDEX.size
+# Set by either side while it waits on its bell, on its own cache line.
+_CONSUMER_WAITING = _HEAD + _INDEX.size
+_PRODUCER_WAITING = _SPILLED + 1
+# Slot header: payload length, negative if the payload spilled
+# into a shared memory block of the slot (then followed by the block's generation,
+# 0 for a block used once).
+_LENGTH = struct.Struct('q')
+
+# Whether the CPU keeps the order of stores to memory, and of loads from it, as
+# seen by other CPUs: the ring publishes its indices with plain stores, relying
+# on it. Weakly ordered CPUs (e.g. ARM, POWER) may show an index before the slots.
+ORDERED_MEMORY = platform.machine().lower() in ('x86_64', 'amd64', 'x86', 'i386', 'i686')
+
+# Waits back off exponentially up to this delay, then block on a bell.
+_MAX_DELAY = 0.001
+# Longest wait on a bell: a ring of the bell may be missed, see _Bell.wait().
+_BELL_WAIT = 0.05
+
+
+def _spill_name(name:str, slot:int, once:bool=False)->str:
+    """Return the name of the spill block of *slot*, kept for reuse
+    or else used *once*: a slot holds a single item, so names are not reused
+    before the consumer removed the block."""
+    return f'{name}_{slot}_1' if once else f'{name}_{slot}'
+
+
+def _map_spill(name:str, size:int=0)->SharedMemory:
+    """Map the spill block *name*, creating it with *size* bytes if given."""
+    spill = SharedMemory(name, create=bool(size), size=size)
+    # The mapping outlives the file descriptor:
+    # don't keep one open per spill block.
+    if getattr(spill, '_fd', -1) >= 0:
+        os.close(spill._fd)
+        spill._fd = -1
+    return spill
+
+
+class _Bell:
+    """A pipe on which one side of the ring waits for the other
+    to publish its index, instead of polling the index.
+    The other side only rings the bell while the flag at *offset* is set."""
+
+    def __init__(self, offset:int):
+        self._offset = offset
+        self._waiter, self._ringer = multiprocessing.Pipe(duplex=False)
+
+    def wait(self, buf:memoryview, ready:Callable[[], bool], timeout:float):
+        """Wait at most *timeout* seconds for a ring, unless *ready()* already."""
+        buf[self._offset] = 1
+        # The flag is set before checking again: a publication from now on rings.
+        # Without memory barriers, a publication racing with this may still
+        # see the flag unset, hence the timeout.
+        if not ready() and self._waiter.poll(timeout):
+            while self._waiter.poll(0):
+                self._waiter.recv_bytes()
+        buf[self._offset] = 0
+
+    def ring(self, buf:memoryview):
+        """Wake the other side up if it waits."""
+        if buf[self._offset]:
+            buf[self._offset] = 0
+            self._ringer.send_bytes(b'')
+
+    def close(self):
+        self._waiter.close()
+        self._ringer.close()
+
+
+def _release(shm: SharedMemory, size:int, pid:int):
+    # A forked child may collect its copy of the tube: only its creator removes it.
+    if os.getpid() != pid:
+        return
+    if shm.buf[_SPILLED]:
+        for slot in range(size):
+            for once in (False, True):
+                try:
+                    spill = SharedMemory(_spill_name(shm.name, slot, once))
+                except FileNotFoundError:
+                    continue
+                spill.close()
+                spill.unlink()
+    shm.close()
+    shm.unlink()
+
+
+class TubeRing(Tube[T]):
+    """A unidirectional communication channel
+    using a lock-free ring buffer in :class:`multiprocessing.shared_memory.SharedMemory`
+    for underlying implementation.
+
+    The tube is safe for a single producer and a single consumer only,
+    i.e. a stage of one worker fed by a single upstream worker (or the pipeline).
+    A side waiting on the other backs off briefly, then blocks on a pipe
+    until the other side publishes its index.
+    Items are pickled into one of *size* slots of *slot_size* bytes;
+    larger items spill into a shared memory block of the slot.
+    Spill blocks are kept and reused for the slot's later items, up to
+    *spill_keep* bytes of them in all; the others are removed by the consumer
+    once read. The producer waits for the consumer rather than have more than
+    *spill_limit* bytes of those in flight, save for a single larger item.
+
+    Indices are published without memory barriers, which Python has none of:
+    the ring is only safe on CPUs keeping the order of memory accesses,
+    i.e. x86 (see :data:`ORDERED_MEMORY`). Elsewhere, a consumer may read
+    a slot before the producer's writes to it show."""
+
+    def __init__(self, size:int=1024, slot_size:int=4096, batch:int=1,
+                 spill_keep:int=1 << 20, spill_limit:int=16 << 20):
+        """With *batch* > 1, the producer and the consumer publish their index
+        to the other side only every *batch* items, keeping local copies
+        in between. Buffered items are published by :meth:`flush`."""
+        if size <= 0 or size & (size-1):
+            raise ValueError('size must be a power of two')
+        if not 0 < batch <= size:
+            raise ValueError('batch must be between 1 and size')
+        self._size = size
+        self._slot_size = slot_size
+        self._batch = batch
+        self._spill_keep = spill_keep
+        self._spill_limit = spill_limit
+        self._shm = SharedMemory(create=True, size=_SLOTS + size*slot_size)
+        self._finalizer = weakref.finalize(self, _release, self._shm, size, os.getpid())
+        # Rung for a consumer waiting on an empty ring, and a producer on a full one.
+        self._consumer_bell = _Bell(_CONSUMER_WAITING)
+        self._producer_bell = _Bell(_PRODUCER_WAITING)
+        self._attach()
+
+    def __getstate__(self):
+        return (self._shm.name, self._size, self._slot_size, self._batch,
+                self._spill_keep, self._spill_limit,
+                self._consumer_bell, self._producer_bell)
+
+    def __setstate__(self, state):
+        (name, self._size, self._slot_size, self._batch,
+         self._spill_keep, self._spill_limit,
+         self._consumer_bell, self._producer_bell) = state
+        self._shm = SharedMemory(name)
+        self._finalizer = None
+        self._attach()
+
+    def _attach(self):
+        self._buf = self._shm.buf
+        # Producer-local copies.
+        self._local_tail = self._pub_tail = _INDEX.unpack_from(self._buf, _TAIL)[0]
+        self._head_cached = _INDEX.unpack_from(self._buf, _HEAD)[0]
+        # Consumer-local copies.
+        self._local_head = self._pub_head = self._head_cached
+        self._tail_cached = self._pub_tail
+        # Spill blocks kept by slot: the producer's, and the consumer's attached
+        # ones, along with their generation.
+        self._spills = dict[int,tuple[int,SharedMemory]]()
+        self._attached = dict[int,tuple[int,SharedMemory]]()
+        self._generation = 0
+        self._kept = 0
+        # Index and size of the items in blocks used once, until consumed.
+        self._in_flight = collections.deque[tuple[int,int]]()
+        self._in_flight_size = 0
+
+    def _spill(self, tail:int, slot:int, payload:bytes)->int:
+        """Copy *payload*, the item at index *tail*, into a spill block of *slot*.
+        Return the generation of the block, 0 for a block used once."""
+        generation, spill = self._spills.get(slot, (0, None))
+        if spill is None or spill.size < len(payload):
+            if spill is not None:
+                # The slot was consumed, so the block is no longer read.
+                del self._spills[slot]
+                self._kept -= spill.size
+                spill.close()
+                spill.unlink()
+            size = 1 << (len(payload)-1).bit_length()
+            self._buf[_SPILLED] = 1
+            if self._kept + size > self._spill_keep:
+                return self._spill_once(tail, slot, payload)
+            spill = _map_spill(_spill_name(self._shm.name, slot), size)
+            self._generation += 1
+            generation = self._generation
+            self._spills[slot] = (generation, spill)
+            self._kept += spill.size
+        spill.buf[:len(payload)] = payload
+        return generation
+
+    def _spill_once(self, tail:int, slot:int, payload:bytes)->int:
+        """Copy *payload* into a block of *slot* that the consumer removes once read."""
+        # Wait for the oldest items in flight to be consumed, if too many bytes are.
+        while self._in_flight and self._in_flight_size + len(payload) > self._spill_limit:
+            index, size = self._in_flight.popleft()
+            if self._head_cached <= index:
+                self._wait_head(index+1)
+            self._in_flight_size -= size
+        spill = _map_spill(_spill_name(self._shm.name, slot, once=True), len(payload))
+        spill.buf[:len(payload)] = payload
+        spill.close()
+        self._in_flight.append((tail, len(payload)))
+        self._in_flight_size += len(payload)
+        return 0
+
+    def _wait_head(self, head:int):
+        """Wait for the consumer to have read the items before *head*."""
+        buf = self._buf
+        # Let the consumer read what was put so far.
+        self._publish_tail()
+        def ready()->bool:
+            return _INDEX.unpack_from(buf, _HEAD)[0] >= head
+        delay = 0.0
+        while (head_now := _INDEX.unpack_from(buf, _HEAD)[0]) < head:
+            if delay < _MAX_DELAY:
+                time.sleep(delay)
+                delay = min(delay*2 or 1e-6, _MAX_DELAY)
+            else:
+                self._producer_bell.wait(buf, ready, _BELL_WAIT)
+        self._head_cached = head_now
+
+    def put(self, data:T):
+        """Put an item on the tube.
+
+        Blocks if tube is full, until the consumer frees a slot."""
+        self.put_raw(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+    def put_raw(self, payload:bytes):
+        """Put an item, already pickled into *payload*, on the tube."""
+        buf = self._buf
+        tail = self._local_tail
+        if tail - self._head_cached >= self._size:
+            self._wait_head(tail - self._size + 1)
+
+        slot = tail & (self._size-1)
+        offset = _SLOTS + slot*self._slot_size
+        if _LENGTH.size + len(payload) <= self._slot_size:
+            _LENGTH.pack_into(buf, offset, len(payload))
+            buf[offset+_LENGTH.size:offset+_LENGTH.size+len(payload)] = payload
+        else:
+            _LENGTH.pack_into(buf, offset, -len(payload))
+            _INDEX.pack_into(buf, offset+_LENGTH.size, self._spill(tail, slot, payload))
+
+        self._local_tail = tail+1
+        if self._local_tail - self._pub_tail >= self._batch:
+            self._publish_tail()
+
+    def _publish_tail(self):
+        # Publish the slots only after they have been written.
+        _INDEX.pack_into(self._buf, _TAIL, self._local_tail)
+        self._pub_tail = self._local_tail
+        self._consumer_bell.ring(self._buf)
+
+    def _publish_head(self):
+        # Free the slots only after they have been read.
+        _INDEX.pack_into(self._buf, _HEAD, self._local_head)
+        self._pub_head = self._local_head
+        self._producer_bell.ring(self._buf)
+
+    def flush(self):
+        """Publish the items put since the last publication."""
+        if self._local_tail != self._pub_tail:
+            self._publish_tail()
+
+    def get(self, timeout:float|None=None)->T:
+        """Return the next available item from the tube.
+
+        Blocks if tube is empty, until a producer for the tube puts an item on it."""
+        buf = self._buf
+        head = self._local_head
+        if head >= self._tail_cached:
+            # Let a producer waiting on a full ring go on before we wait ourselves.
+            if head != self._pub_head:
+                self._publish_head()
+            deadline = None if timeout is None else time.monotonic() + timeout
+            delay = 0.0
+            def ready()->bool:
+                return head < _INDEX.unpack_from(buf, _TAIL)[0]
+            # Wait for the tail to pass the head, not just to differ from it:
+            # a stale read of the tail must not let us read unwritten slots.
+            while head >= (tail := _INDEX.unpack_from(buf, _TAIL)[0]):
+                if deadline is None:
+                    left = _BELL_WAIT
+                elif (left := deadline - time.monotonic()) <= 0:
+                    raise multiprocessing.TimeoutError
+                if delay < _MAX_DELAY:
+                    time.sleep(min(delay, left))
+                    delay = min(delay*2 or 1e-6, _MAX_DELAY)
+                else:
+                    self._consumer_bell.wait(buf, ready, min(left, _BELL_WAIT))
+            self._tail_cached = tail
+
+        slot = head & (self._size-1)
+        offset = _SLOTS + slot*self._slot_size
+        length = _LENGTH.unpack_from(buf, offset)[0]
+        offset += _LENGTH.size
+        if length >= 0:
+            data = pickle.loads(buf[offset:offset+length])
+        else:
+            generation = _INDEX.unpack_from(buf, offset)[0]
+            attached = self._attached.get(slot)
+            if attached is not None and attached[0] != generation:
+                # The producer replaced the block, or stopped keeping one.
+                del self._attached[slot]
+                attached[1].close()
+                attached = None
+            if generation == 0:
+                spill = _map_spill(_spill_name(self._shm.name, slot, once=True))
+                try:
+                    data = pickle.loads(spill.buf[:-length])
+                finally:
+                    spill.close()
+                    spill.unlink()
+            else:
+                if attached is None:
+                    attached = (generation, _map_spill(_spill_name(self._shm.name, slot)))
+                    self._attached[slot] = attached
+                data = pickle.loads(attached[1].buf[:-length])
+
+        self._local_head = head+1
+        if self._local_head - self._pub_head >= self._batch:
+            self._publish_head()
+        return data
+
+    def close(self):
+        for _, spill in (*self._spills.values(), *self._attached.values()):
+            spill.close()
+        self._consumer_bell.close()
+        self._producer_bell.close()
+        if self._finalizer is not None:
+            self._finalizer()
+        else:
+            self._shm.close()
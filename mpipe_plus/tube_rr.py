@@ -0,0 +1,63 @@
+"""Implements TubeRR class."""
+
+import multiprocessing
+import queue
+import time
+from typing import TypeVar
+
+from .Tube import Tube
+
+T = TypeVar('T')
+
+_POLL_INTERVAL = 0.001
+
+
+class TubeRR(Tube[T]):
+    """A unidirectional communication channel
+    distributing items round-robin over a list of *tubes*,
+    one per consumer, so that consumers don't contend on a single tube.
+
+    Each producer keeps its own round-robin position."""
+
+    def __init__(self, tubes:list[Tube[T]]):
+        self._tubes = tubes
+        self.in_process = all(tube.in_process for tube in tubes)
+        self._next = 0
+
+    def put(self, data:T):
+        """Put an item on the next tube in turn."""
+        self._tubes[self._next].put(data)
+        self._next = (self._next+1) % len(self._tubes)
+
+    def put_raw(self, payload:bytes):
+        """Put an already pickled item on the next tube in turn."""
+        self._tubes[self._next].put_raw(payload)
+        self._next = (self._next+1) % len(self._tubes)
+
+    def broadcast(self, data:T):
+        """Put an item on every tube."""
+        for tube in self._tubes:
+            tube.put(data)
+
+    def get(self, timeout:float|None=None)->T:
+        """Return the next available item from any of the tubes.
+
+        Blocks if all tubes are empty, until a producer puts an item on one."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for tube in self._tubes:
+                try:
+                    return tube.get(0)
+                except (multiprocessing.TimeoutError, queue.Empty):
+                    pass
+            if deadline is not None and time.monotonic() >= deadline:
+                raise multiprocessing.TimeoutError
+            time.sleep(_POLL_INTERVAL)
+
+    def flush(self):
+        for tube in self._tubes:
+            tube.flush()
+
+    def close(self):
+        for tube in self._tubes:
+            tube.close()
@@ -0,0 +1,54 @@
+"""Implements TubeT class."""
+
+import multiprocessing
+import queue
+from typing import TypeVar
+
+from .Tube import Tube
+
+T = TypeVar('T')
+
+
+class TubeT(Tube[T]):
+    """A unidirectional communication channel between threads of one process
+    using :class:`queue.SimpleQueue` for underlying implementation.
+
+    Items are passed by reference, without pickling."""
+
+    in_process = True
+    concurrent_get = True
+    concurrent_put = True
+
+    def __init__(self, maxsize:int=0):
+        """With *maxsize* > 0, producers wait for room rather than put
+        more than *maxsize* items on the tube."""
+        self._queue = queue.SimpleQueue[T]()
+        # A token per free place on a bounded tube, taken by put() and given back by get().
+        self._room:queue.SimpleQueue[None]|None = None
+        if maxsize > 0:
+            self._room = queue.SimpleQueue[None]()
+            for _ in range(maxsize):
+                self._room.put(None)
+
+    def put(self, data:T):
+        """Put an item on the tube.
+
+        Blocks if the tube is full, until a consumer gets an item from it."""
+        if self._room is not None:
+            self._room.get()
+        self._queue.put(data)
+
+    def get(self, timeout:float|None=None)->T:
+        """Return the next available item from the tube.
+
+        Blocks if tube is empty, until a producer for the tube puts an item on it."""
+        try:
+            data = self._queue.get(True, timeout)
+        except queue.Empty:
+            raise multiprocessing.TimeoutError from None
+        if self._room is not None:
+            self._room.put(None)
+        return data
+
+    def close(self):
+        pass
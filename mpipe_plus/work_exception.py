@@ -1,5 +1,6 @@
 
 
+import pickle
 from typing import Any, Generic, TypeVar
 import tblib.pickling_support
 tblib.pickling_support.install()
@@ -10,15 +11,31 @@ class WorkException(Exception,Generic[T]):
     work_item: T|None
     tb: Any    
     def __init__(self, orig_exc: Exception, stage: Any, work_item: T|None):
-        super().__init__(orig_exc, str(stage), work_item)
+        stage=str(stage)
+        super().__init__(orig_exc, stage, work_item)
         self.tb=orig_exc.__traceback__
         self.orig_exc=orig_exc
         self.work_item=work_item
-        self.stage=str(stage)
-    
+        self.stage=stage
+        # The pickled exception, kept to pass it on without pickling it again.
+        self._pickled:bytes|None=None
+
     def __str__(self):
         return f"WorkException {self.stage}, {self.work_item} --> {self.orig_exc}"
-    
+
+    def __reduce__(self):
+        if self._pickled is None:
+            self._pickled=pickle.dumps((self.orig_exc, self.stage, self.work_item, self.tb),
+                                       pickle.HIGHEST_PROTOCOL)
+        return _rebuild, (self._pickled,)
+
     def re_raise(self):
         raise self.with_traceback(self.tb)
-        
\ No newline at end of file
+
+
+def _rebuild(pickled:bytes)->WorkException:
+    orig_exc, stage, work_item, tb = pickle.loads(pickled)
+    exc=WorkException(orig_exc, stage, work_item)
+    exc.tb=tb
+    exc._pickled=pickled
+    return exc
@@ -0,0 +1,157 @@
+"""Tests of Pipeline."""
+
+import itertools
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from mpipe_plus import Pipeline, SimpleStage, Stage, TubeQ, WorkException
+from mpipe_plus.SimpleStage import _Worker
+from mpipe_plus.tube_q import FastQueue
+
+CFG = dict[str,int]()
+_others_done = threading.Event()
+_others = list[int]()
+_gate = threading.Event()
+
+
+def inc(x):
+    return x + 1
+
+
+def scale(x):
+    return x * CFG['k']
+
+
+def big(x):
+    return bytes([x % 256]) * 20000
+
+
+def first(x):
+    return x[0]
+
+
+def wait_for_gate(x):
+    assert _gate.wait(10)
+    return x
+
+
+def wait_for_others(x):
+    # The first task only ends once all the others are done.
+    if x == 0:
+        assert _others_done.wait(10)
+    else:
+        _others.append(x)
+        if len(_others) == 29:
+            _others_done.set()
+    return x
+
+
+def test_run():
+    stage = SimpleStage(inc, 2)
+    stage.link(SimpleStage(inc, 2))
+    assert sorted(Pipeline(stage).run(range(100))) == list(range(2, 102))
+
+
+def test_run_ordered():
+    assert list(Pipeline(SimpleStage(inc, 3)).run(range(100), ordered_results=True)) \
+        == list(range(1, 101))
+
+
+def test_run_bounded():
+    # The feeder waits for the workers rather than put all the inputs at once.
+    pulled = list[int]()
+    def inputs():
+        for x in range(1000):
+            pulled.append(x)
+            yield x
+    results = Pipeline(SimpleStage(wait_for_gate, 3, multi_process=False)).run(inputs())
+    time.sleep(0.1)
+    assert len(pulled) < 100
+    _gate.set()
+    assert sorted(results) == list(range(1000))
+
+
+def test_run_input_error():
+    def inputs():
+        yield from range(3)
+        raise KeyError('in')
+    results = Pipeline(SimpleStage(inc, multi_process=False)).run(inputs(), ordered_results=True)
+    assert next(results) == 1
+    with pytest.raises(KeyError):
+        list(results)
+
+
+@pytest.mark.parametrize('multi_process', [False, True])
+def test_run_close_stops_feeder(multi_process):
+    children = set(multiprocessing.active_children())
+    threads = set(threading.enumerate())
+    results = Pipeline(SimpleStage(inc, 2, multi_process=multi_process)).run(itertools.count())
+    assert next(results) > 0
+    results.close()
+    assert not any(thread.name == 'pipeline-feed' for thread in threading.enumerate())
+    # The workers are done too.
+    assert set(multiprocessing.active_children()) <= children
+    assert set(threading.enumerate()) <= threads
+
+
+def test_idle_workers_take_next_task():
+    stage = SimpleStage(wait_for_others, 3, multi_process=False)
+    assert sorted(Pipeline(stage).run(range(30))) == list(range(30))
+
+
+def test_shared_tubes_in_turns():
+    # Several processes put large items on a pipe, several others read them.
+    stage = SimpleStage(big, 2)
+    stage.link(SimpleStage(first, 3))
+    assert sorted(Pipeline(stage).run(range(2000))) == sorted(x % 256 for x in range(2000))
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                    reason='workers only inherit the parent state when forked')
+def test_default_start_method_inherits_state():
+    CFG['k'] = 3
+    assert sorted(Pipeline(SimpleStage(scale, 2)).run(range(5))) == [0, 3, 6, 9, 12]
+
+
+@pytest.mark.skipif('forkserver' not in multiprocessing.get_all_start_methods(),
+                    reason='no fork server on this platform')
+@pytest.mark.parametrize('on_stage', [False, True])
+def test_forkserver(on_stage):
+    stage = SimpleStage(inc, 2, start_method='forkserver' if on_stage else None)
+    stage.link(SimpleStage(inc))
+    pipe = Pipeline(stage, start_method=None if on_stage else 'forkserver')
+    assert sorted(pipe.run(range(20))) == list(range(2, 22))
+
+
+def test_conflicting_start_methods():
+    stage = SimpleStage(inc, start_method='spawn')
+    stage.link(SimpleStage(inc, start_method='forkserver'))
+    with pytest.raises(ValueError):
+        Pipeline(stage)
+
+
+@pytest.mark.parametrize('num_worker', [1, 3])
+def test_ring(num_worker):
+    stage = SimpleStage(inc, num_worker, ring=True)
+    stage.link(SimpleStage(inc, ring=True))
+    assert sorted(Pipeline(stage).run(range(1000))) == list(range(2, 1002))
+
+
+@pytest.mark.parametrize('max_size_bytes', [
+    None,
+    pytest.param(1 << 16, marks=pytest.mark.skipif(FastQueue is None,
+                                                   reason='faster-fifo is not installed'))])
+def test_tube_q(max_size_bytes):
+    # Processes only inherit the queues, on startup of the pool.
+    stage = SimpleStage(inc, 2, max_backlog=8)
+    stage.link(Stage(_Worker, 2, input_tube=TubeQ(max_size_bytes=max_size_bytes), task_fn=inc))
+    assert sorted(Pipeline(stage).run(range(200))) == list(range(2, 202))
+
+
+def test_worker_not_started():
+    # The function can't be pickled along with the workers' task.
+    with pytest.raises(WorkException):
+        list(Pipeline(SimpleStage(lambda x: x, 2)).run(range(10)))
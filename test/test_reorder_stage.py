@@ -0,0 +1,38 @@
+"""Tests of ReorderStage."""
+
+import random
+import time
+
+import pytest
+
+from mpipe_plus import Pipeline, ReorderStage, SimpleStage
+
+
+def jitter(x):
+    time.sleep(random.random()*0.002)
+    return x
+
+
+def drop_sevens(x):
+    time.sleep(random.random()*0.002)
+    return None if x % 7 == 3 else x
+
+
+@pytest.mark.parametrize('multi_process', [False, True])
+def test_reorder(multi_process):
+    stage = SimpleStage(jitter, 4, multi_process=multi_process)
+    stage.link(ReorderStage(multi_process=multi_process))
+    assert list(Pipeline(stage).run(range(300))) == list(range(300))
+
+
+def test_reorder_without_some_results():
+    # The results after a task without result are held back until "stop".
+    stage = SimpleStage(drop_sevens, 4)
+    stage.link(ReorderStage())
+    assert list(Pipeline(stage).run(range(300))) == [x for x in range(300) if x % 7 != 3]
+
+
+def test_reorder_batches():
+    stage = SimpleStage(jitter, 3, batch_size=4)
+    stage.link(ReorderStage())
+    assert list(Pipeline(stage).run(range(300), batch_size=5)) == list(range(300))
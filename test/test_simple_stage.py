@@ -0,0 +1,80 @@
+"""Tests of SimpleStage."""
+
+import pytest
+
+from mpipe_plus import Pipeline, SimpleStage, WorkException
+
+_batch_sizes = list[int]()
+
+
+def inc(x):
+    return x + 1
+
+
+def dbl(x):
+    return x * 2
+
+
+def drop_sevens(x):
+    return None if x % 7 == 3 else x
+
+
+def twice(tasks):
+    # Vectorized: all the tasks of a micro-batch at once.
+    _batch_sizes.append(len(tasks))
+    if 13 in tasks:
+        raise ValueError(13)
+    return [x*2 if x % 5 else None for x in tasks]
+twice.__vectorized__ = True
+
+
+@pytest.mark.parametrize('multi_process', [False, True])
+def test_chain(multi_process):
+    stage = SimpleStage.chain([inc, drop_sevens, dbl], num_worker=2, multi_process=multi_process)
+    assert sorted(Pipeline(stage).run(range(100))) \
+        == [(x+1)*2 for x in range(100) if (x+1) % 7 != 3]
+
+
+@pytest.mark.parametrize('multi_process', [False, True])
+def test_fuse(multi_process):
+    # Stages alike are merged; a stage of a different size starts a new one.
+    first = SimpleStage(inc, 2, multi_process=multi_process)
+    second = SimpleStage(dbl, 2, multi_process=multi_process)
+    third = SimpleStage(drop_sevens, 2, multi_process=multi_process)
+    last = SimpleStage(inc, 1, multi_process=multi_process)
+    first.link(second)
+    second.link(third)
+    third.link(last)
+    pipeline = Pipeline(first, fuse=True)
+    assert len(first.get_stages()) == 2
+    assert sorted(pipeline.run(range(100))) \
+        == [(x+1)*2+1 for x in range(100) if (x+1)*2 % 7 != 3]
+
+
+def test_fuse_keeps_forks():
+    first = SimpleStage(inc)
+    first.link(SimpleStage(dbl))
+    first.link(SimpleStage(inc))
+    pipeline = Pipeline(first, fuse=True)
+    assert len(first.get_stages()) == 3
+    assert sorted(pipeline.run(range(10))) \
+        == sorted([(x+1)*2 for x in range(10)] + [x+2 for x in range(10)])
+
+
+@pytest.mark.parametrize('batch_size', [1, 8])
+def test_vectorized(batch_size):
+    _batch_sizes.clear()
+    stage = SimpleStage(twice, 2, multi_process=False, batch_size=batch_size)
+    inputs = [x for x in range(100) if x != 13]
+    assert sorted(Pipeline(stage).run(inputs, batch_size=batch_size)) \
+        == [x*2 for x in inputs if x % 5]
+    assert max(_batch_sizes) == batch_size
+
+
+@pytest.mark.parametrize('batch_size', [1, 8])
+def test_vectorized_error(batch_size):
+    stage = SimpleStage(twice, multi_process=True, batch_size=batch_size)
+    with pytest.raises(WorkException, match='13') as error:
+        list(Pipeline(stage).run(range(30), batch_size=batch_size))
+    # Labeled with the worker, named after the function.
+    assert error.value.stage == 'twice[0]'
@@ -0,0 +1,113 @@
+"""Tests of TubeP."""
+
+import collections
+import mmap
+import multiprocessing
+import os
+import pickle
+from multiprocessing import resource_tracker
+
+import pytest
+
+from mpipe_plus import TubeP
+
+
+def _consume(tube, n, results):
+    results.put([tube.get() for _ in range(n)])
+
+
+def _consume_bytes(tube, n, results):
+    results.put([bytes(tube.get()) for _ in range(n)])
+
+
+def test_put_get():
+    tube = TubeP()
+    tube.put(1)
+    tube.put_raw(b'\x80\x05K\x02.')
+    assert [tube.get(5) for _ in range(2)] == [1, 2]
+    with pytest.raises(multiprocessing.TimeoutError):
+        tube.get(0.01)
+    tube.close()
+
+
+def test_batch_needs_flush():
+    tube = TubeP(batch=4)
+    tube.put(1)
+    with pytest.raises(multiprocessing.TimeoutError):
+        tube.get(0.01)
+    tube.flush()
+    assert tube.get(5) == 1
+    tube.close()
+
+
+def test_batch_size():
+    with pytest.raises(ValueError):
+        TubeP(batch=0)
+
+
+def test_batch_across_processes():
+    items = [i if i % 7 else bytes(3000) for i in range(200)]
+    tube = TubeP(batch=8)
+    results = multiprocessing.Queue()
+    consumer = multiprocessing.Process(target=_consume, args=(tube, len(items), results))
+    consumer.start()
+    for item in items:
+        tube.put(item)
+    tube.flush()
+    assert results.get(timeout=30) == items
+    consumer.join()
+    tube.close()
+
+
+def _shm_blocks():
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+
+def test_out_of_band():
+    # Large buffers go through shared memory, removed once loaded.
+    before = _shm_blocks()
+    tube = TubeP()
+    tube.put([pickle.PickleBuffer(bytearray(b'a'*200000)), pickle.PickleBuffer(bytearray(100)), 3])
+    if os.path.isdir('/dev/shm'):
+        assert len(_shm_blocks() - before) == 1
+    big, small, n = tube.get(5)
+    assert bytes(big) == b'a'*200000 and bytes(small) == bytes(100) and n == 3
+    assert not _shm_blocks() - before
+    tube.close()
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='no shared memory file descriptors')
+def test_out_of_band_no_copy():
+    # The loaded buffer maps the shared memory block, rather than copy it.
+    tube = TubeP()
+    tube.put(pickle.PickleBuffer(bytearray(b'a'*100000)))
+    view = tube.get(5)
+    assert isinstance(view.obj, mmap.mmap)
+    assert bytes(view) == b'a'*100000
+    tube.close()
+
+
+def test_out_of_band_untracked(monkeypatch):
+    # The consumer alone tracks the blocks, from loading them until removing them.
+    tracked = collections.Counter()
+    monkeypatch.setattr(resource_tracker, 'register', lambda name, rtype: tracked.update([name]))
+    monkeypatch.setattr(resource_tracker, 'unregister', lambda name, rtype: tracked.subtract([name]))
+    tube = TubeP()
+    tube.put(pickle.PickleBuffer(bytearray(100000)))
+    tube.get(5)
+    assert not +tracked
+    tube.close()
+
+
+def test_out_of_band_across_processes():
+    items = [pickle.PickleBuffer(bytearray([i])*100000) for i in range(5)]
+    tube = TubeP(batch=2)
+    results = multiprocessing.Queue()
+    consumer = multiprocessing.Process(target=_consume_bytes, args=(tube, len(items), results))
+    consumer.start()
+    for item in items:
+        tube.put(item)
+    tube.flush()
+    assert results.get(timeout=30) == [bytes([i])*100000 for i in range(5)]
+    consumer.join()
+    tube.close()
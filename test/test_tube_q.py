@@ -0,0 +1,46 @@
+"""Tests of TubeQ."""
+
+import multiprocessing
+
+import pytest
+
+from mpipe_plus import TubeQ
+from mpipe_plus.tube_q import FastQueue
+
+
+def _consume(tube, n, results):
+    results.put([tube.get() for _ in range(n)])
+
+
+@pytest.mark.parametrize('maxsize', [0, 4])
+def test_put_get(maxsize):
+    tube = TubeQ(maxsize)
+    tube.put(1)
+    tube.put_raw(b'\x80\x05K\x02.')
+    tube.put_many([3, 4])
+    assert [tube.get(5) for _ in range(4)] == [1, 2, 3, 4]
+    with pytest.raises(multiprocessing.TimeoutError):
+        tube.get(0.01)
+    tube.close()
+
+
+@pytest.mark.skipif(FastQueue is None, reason='faster-fifo is not installed')
+def test_fast_item_too_large():
+    tube = TubeQ(max_size_bytes=1000)
+    with pytest.raises(ValueError):
+        tube.put(bytes(1000))
+
+
+@pytest.mark.skipif(FastQueue is None, reason='faster-fifo is not installed')
+def test_fast_backlog_larger_than_queue():
+    # The items don't fit in the queue all at once: put waits for the consumer.
+    items = [bytes([i])*300 for i in range(20)]
+    tube = TubeQ(max_size_bytes=1000)
+    results = multiprocessing.Queue()
+    consumer = multiprocessing.Process(target=_consume, args=(tube, 2*len(items), results))
+    consumer.start()
+    tube.put_many(items)
+    for item in items:
+        tube.put(item)
+    assert results.get(timeout=30) == items*2
+    consumer.join()
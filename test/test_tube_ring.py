@@ -0,0 +1,137 @@
+"""Tests of TubeRing."""
+
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from mpipe_plus import TubeRing
+
+
+def _consume(tube, n, results):
+    results.put([tube.get() for _ in range(n)])
+
+
+def _consume_later(tube, n, results):
+    time.sleep(0.1)
+    _consume(tube, n, results)
+
+
+def _produce_later(tube, items):
+    for item in items:
+        time.sleep(0.1)
+        tube.put(item)
+
+
+def test_put_get():
+    tube = TubeRing(4, 64)
+    for i in range(3):
+        tube.put(i)
+    assert [tube.get() for _ in range(3)] == [0, 1, 2]
+    tube.close()
+
+
+def test_get_timeout():
+    tube = TubeRing(4, 64)
+    with pytest.raises(multiprocessing.TimeoutError):
+        tube.get(0.01)
+    tube.close()
+
+
+def test_size_power_of_two():
+    with pytest.raises(ValueError):
+        TubeRing(3, 64)
+
+
+def test_spill():
+    tube = TubeRing(4, 64)
+    items = [b'x'*10, b'y'*1000, b'z'*10, b'w'*5000, b'v'*1000]
+    for item in items:
+        tube.put(item)
+        assert tube.get() == item
+    tube.close()
+
+
+def _spill_blocks(tube):
+    prefix = tube._shm.name.lstrip('/') + '_'
+    return [name for name in os.listdir('/dev/shm') if name.startswith(prefix)]
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='no /dev/shm to look into')
+def test_spill_keep():
+    # Blocks past spill_keep are used once, and removed once read.
+    tube = TubeRing(4, 64, spill_keep=16384)
+    for item in (bytes(1000), bytes(5000), bytes(100000)):
+        tube.put(item)
+    assert len(_spill_blocks(tube)) == 3
+    assert [len(tube.get()) for _ in range(3)] == [1000, 5000, 100000]
+    assert len(_spill_blocks(tube)) == 2
+    tube.put(bytes(100000))
+    assert len(tube.get()) == 100000
+    assert len(_spill_blocks(tube)) == 2
+    tube.close()
+    assert not _spill_blocks(tube)
+
+
+def test_spill_limit():
+    # The producer waits for large items to be read rather than exceed spill_limit.
+    items = [bytes([i])*50000 for i in range(20)]
+    tube = TubeRing(16, 64, spill_keep=0, spill_limit=120000)
+    results = multiprocessing.Queue()
+    consumer = multiprocessing.Process(target=_consume_later, args=(tube, len(items), results))
+    consumer.start()
+    start = time.monotonic()
+    for item in items[:3]:
+        tube.put(item)
+    assert time.monotonic() - start >= 0.05
+    for item in items[3:]:
+        tube.put(item)
+    assert results.get(timeout=30) == items
+    consumer.join()
+    tube.close()
+
+
+def test_batch_needs_flush():
+    tube = TubeRing(8, 64, batch=4)
+    tube.put(1)
+    with pytest.raises(multiprocessing.TimeoutError):
+        tube.get(0.01)
+    tube.flush()
+    assert tube.get() == 1
+    tube.close()
+
+
+def test_across_processes():
+    # More items than slots: the producer waits for the consumer to free them.
+    items = [i if i % 7 else bytes(300) for i in range(200)]
+    tube = TubeRing(8, 64, batch=2)
+    results = multiprocessing.Queue()
+    consumer = multiprocessing.Process(target=_consume, args=(tube, len(items), results))
+    consumer.start()
+    for item in items:
+        tube.put(item)
+    tube.flush()
+    assert results.get(timeout=30) == items
+    consumer.join()
+    tube.close()
+
+
+def test_wait_on_bell():
+    # Waits longer than the back-off block on the bells, both ways.
+    tube = TubeRing(2, 64)
+    producer = multiprocessing.Process(target=_produce_later, args=(tube, range(3)))
+    producer.start()
+    assert [tube.get(5) for _ in range(3)] == [0, 1, 2]
+    producer.join()
+    tube.close()
+
+    tube = TubeRing(2, 64)
+    results = multiprocessing.Queue()
+    consumer = multiprocessing.Process(target=_consume_later, args=(tube, 3, results))
+    consumer.start()
+    for i in range(3):
+        tube.put(i)
+    assert results.get(timeout=30) == [0, 1, 2]
+    consumer.join()
+    tube.close()
@@ -0,0 +1,120 @@
+"""Tests of workers running in a pipeline."""
+
+import gc
+import threading
+import time
+import weakref
+
+import pytest
+
+from mpipe_plus import Pipeline, SimpleStage, Stage, TubeP, WorkException, Worker
+from mpipe_plus.SimpleStage import _Worker
+
+_batches = list[tuple[int,...]]()
+
+
+def inc(x):
+    return x + 1
+
+
+def dbl(x):
+    return x * 2
+
+
+def fail_on_5(x):
+    if x == 5:
+        raise ValueError(x)
+    return x
+
+
+class _RecordingWorker(Worker):
+    """Records the micro-batches it gets."""
+
+    def doTask(self, task):
+        return task
+
+    def doTaskBatch(self, tasks):
+        _batches.append(tasks)
+        return list(tasks)
+
+
+class _SumWorker(Worker):
+    """Adds to each task the sum of its micro-batch."""
+
+    def doTask(self, task):
+        return self.doTaskBatch((task,))[0]
+
+    def doTaskBatch(self, tasks):
+        total = sum(tasks)
+        return [task + total for task in tasks]
+
+
+def test_stop_flushes_results():
+    # Every worker of the first stage buffers results in the batched tube:
+    # those that stop first must still publish them.
+    stage = SimpleStage(inc, num_worker=3)
+    stage.link(Stage(_Worker, 1, input_tube=TubeP(batch=8), task_fn=dbl))
+    results = Pipeline(stage).run(range(100))
+    assert sorted(results) == [(x+1)*2 for x in range(100)]
+
+
+@pytest.mark.parametrize('multi_process', [False, True])
+def test_do_task_batch(multi_process):
+    # The input micro-batches reach doTaskBatch() whole.
+    stage = Stage(_SumWorker, 2, multi_process, batch_size=4, batch_timeout=0.01)
+    results = sorted(Pipeline(stage).run(range(8), batch_size=4))
+    assert results == sorted([x + 6 for x in range(4)] + [x + 22 for x in range(4, 8)])
+
+
+def test_micro_batch_size():
+    # The pipeline's micro-batches are coalesced, then cut to the stage's batch size.
+    _batches.clear()
+    stage = Stage(_RecordingWorker, 1, False, batch_size=8, batch_timeout=0.1)
+    assert sorted(Pipeline(stage).run(range(100), batch_size=5)) == list(range(100))
+    assert max(len(batch) for batch in _batches) == 8
+    assert sorted(x for batch in _batches for x in batch) == list(range(100))
+
+
+@pytest.mark.parametrize('multi_process', [False, True])
+def test_stop_counter(multi_process):
+    # Every worker counts itself stopped, even those that got no task:
+    # the last one of each stage passes "stop" on.
+    stage = SimpleStage(inc, 4, multi_process=multi_process)
+    last = SimpleStage(dbl, 3, multi_process=multi_process)
+    stage.link(last)
+    assert sorted(Pipeline(stage).run(range(2))) == [2, 4]
+    assert stage._stop_counter.value == 4
+    assert last._stop_counter.value == 3
+
+
+def test_synchronized_released():
+    # Thread pools run in this process: their stop counters and locks must not outlive them.
+    stage = SimpleStage(inc, 2, multi_process=False)
+    assert sorted(Pipeline(stage).run(range(3))) == [1, 2, 3]
+    counter = weakref.ref(stage._stop_counter)
+    del stage
+    gc.collect()
+    assert counter() is None
+
+
+def test_pin_failure_warns(caplog):
+    stage = Stage(_Worker, 1, multi_process=False, cpu_affinity=[[1 << 20]], task_fn=inc)
+    assert sorted(Pipeline(stage).run(range(3))) == [1, 2, 3]
+    assert 'Cannot pin worker' in caplog.text
+
+
+@pytest.mark.parametrize('multi_process', [False, True])
+def test_prefetch(multi_process):
+    stage = SimpleStage(inc, 2, multi_process=multi_process, prefetch=4)
+    stage.link(SimpleStage(dbl, multi_process=multi_process, prefetch=1))
+    assert sorted(Pipeline(stage).run(range(200))) == [(x+1)*2 for x in range(200)]
+
+
+def test_prefetch_stops_on_failure():
+    stage = SimpleStage(fail_on_5, multi_process=False, prefetch=2)
+    with pytest.raises(WorkException):
+        list(Pipeline(stage).run(range(10)))
+    deadline = time.monotonic() + 5
+    while any(thread.name.endswith('-prefetch') for thread in threading.enumerate()):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)